@@ -0,0 +1,97 @@
+import threading
+
+from .logger import logger
+
+
+class AdmissionRejected(Exception):
+
+    def __init__(self, endpoint_class, reason):
+        super().__init__('%s request rejected: %s' % (endpoint_class, reason))
+        self.endpoint_class = endpoint_class
+
+
+class AdmissionPool():
+    """
+    Limits the number of concurrent requests, with a bounded queue of requests waiting for a slot
+    """
+
+    def __init__(self, concurrency, queue_size, queue_timeout):
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.slots.acquire(blocking=False):
+            return True
+        with self.lock:
+            # Fail fast when the queue is full
+            if self.waiting >= self.queue_size:
+                return False
+            self.waiting += 1
+        try:
+            return self.slots.acquire(timeout=self.queue_timeout)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+
+    def release(self):
+        self.slots.release()
+
+
+class AdmissionController():
+    """
+    Admits requests according to the concurrency limits of their endpoint class, and of their client in that class.
+
+    :param limits: A dict mapping endpoint classes to (concurrency, queue size) tuples
+    :param client_limits: A dict mapping endpoint classes to the maximum number of concurrent requests of a single
+    client in that class
+    :param queue_timeout: Maximum time (in seconds) a request waits in the queue before being rejected
+    """
+
+    def __init__(self, limits=None, client_limits=None, queue_timeout=5):
+        self.pools = dict(
+            (endpoint_class, AdmissionPool(concurrency, queue_size, queue_timeout))
+            for endpoint_class, (concurrency, queue_size) in (limits or {}).items()
+        )
+        self.client_limits = client_limits or {}
+        self.active = dict()
+        self.lock = threading.Lock()
+
+    def admit(self, endpoint_class, client_key):
+        """
+        :return: A token to pass to `release` when the request is done
+        :raises AdmissionRejected: when the request cannot be admitted
+        """
+        client_limit = self.client_limits.get(endpoint_class)
+        client = None
+        if client_limit is not None:
+            client = (endpoint_class, client_key)
+            with self.lock:
+                if self.active.get(client, 0) >= client_limit:
+                    logger.warning('Rejecting %s request of %s: too many concurrent requests',
+                                   endpoint_class, client_key)
+                    raise AdmissionRejected(endpoint_class, 'too many concurrent requests from client')
+                self.active[client] = self.active.get(client, 0) + 1
+
+        pool = self.pools.get(endpoint_class)
+        if pool is not None and not pool.acquire():
+            self._release_client(client)
+            logger.warning('Rejecting %s request of %s: queue is full', endpoint_class, client_key)
+            raise AdmissionRejected(endpoint_class, 'too many concurrent requests')
+        return (pool, client)
+
+    def release(self, token):
+        pool, client = token
+        if pool is not None:
+            pool.release()
+        self._release_client(client)
+
+    def _release_client(self, client):
+        if client is None:
+            return
+        with self.lock:
+            self.active[client] -= 1
+            if self.active[client] == 0:
+                del self.active[client]
@@ -1,15 +1,46 @@
+import decimal
+import hashlib
 import json
 
-from flask import Blueprint, make_response, request, current_app, send_file, abort
+from flask import Blueprint, request, current_app, send_file, abort, stream_with_context, g, url_for
 from flask_jsonpify import jsonpify
 
-import demjson3 as demjson
-
 from .controllers import Controllers
-from .sources import extract_text_fields
+from .sources import load_sources, extract_text_fields, extract_schemas, extract_title_fields
 from .logger import logger, logging
-from .utils.file_maker import get_csv, get_xls, get_xlsx
+from .utils.file_maker import iter_csv, iter_ndjson, get_xls, get_xlsx, get_parquet
+from .utils.compression import available_encodings, compress, compress_stream
 from .query import Query
+from .slow_queries import SlowQueryLog
+from .admission import AdmissionController, AdmissionRejected
+from .cache import MemoryCacheBackend, ResponseCache
+from .profiling import RequestProfiler
+from .hedging import Hedger
+from .templates import SearchTemplates
+from .warmup import Warmup, load_warmup_log
+
+
+# Endpoint classes for admission control (other endpoints are in the 'search' class)
+ENDPOINT_CLASSES = dict(
+    simple_count_handler='count',
+    facets_handler='count',
+    download='download',
+    suggest_handler='suggest',
+)
+
+
+def default_client_key():
+    # Forwarding headers are set by the client, so they're only trusted when applied by ProxyFix
+    return request.remote_addr
+
+
+def fast_json_default(value):
+    # Types which orjson doesn't encode by itself (encoded as Flask's JSON provider does)
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
 
 
 def default_rules(field):
@@ -42,7 +73,48 @@ class APIESBlueprint(Blueprint):
                  multi_match_type='most_fields',
                  multi_match_operator='and',
                  debug_queries=False,
-                 query_cls=Query):
+                 query_cls=Query,
+                 request_cache=False,
+                 date_rounding=None,
+                 fast_json=False,
+                 slow_query_threshold=None,
+                 slow_query_took_threshold=None,
+                 slow_query_profile_rate=0.0,
+                 slow_query_profile_dir=None,
+                 export_slices=4,
+                 export_workers=8,
+                 export_max_slices=16,
+                 export_batch_size=1000,
+                 compression=None,
+                 compression_min_size=1024,
+                 search_timeout=None,
+                 search_batch_max_size=20,
+                 admission_limits=None,
+                 admission_client_limits=None,
+                 admission_client_key=default_client_key,
+                 admission_queue_timeout=5,
+                 admission_retry_after=1,
+                 cache_ttl=None,
+                 cache_stale_ttl=0,
+                 cache_stale_if_error=0,
+                 cache_max_entries=1000,
+                 cache_backend=None,
+                 suggest_fields=None,
+                 suggest_cache_ttl=60,
+                 suggest_cache_prefix_length=3,
+                 suggest_cache_max_entries=10000,
+                 search_preference=None,
+                 search_routing=None,
+                 profile_header=None,
+                 profile_token=None,
+                 profile_rate=0.0,
+                 profile_dir=None,
+                 profiler=None,
+                 hedge_percentile=None,
+                 hedge_max_extra_load=0.05,
+                 search_templates=False,
+                 warmup=None,
+                 warmup_concurrency=2):
         super().__init__('apies', 'apies')
 
         if debug_queries:
@@ -54,14 +126,40 @@ class APIESBlueprint(Blueprint):
             # deprecation message:
             logger.warning('dont_highlight is deprecated, use request parameters instead')
 
+        slow_query_log = None
+        if slow_query_threshold is not None or slow_query_took_threshold is not None:
+            slow_query_log = SlowQueryLog(
+                threshold=slow_query_threshold,
+                took_threshold=slow_query_took_threshold,
+                profile_rate=slow_query_profile_rate,
+                profile_dir=slow_query_profile_dir
+            )
+
+        sources = load_sources(sources)
+        self.schemas = extract_schemas(sources)
+
+        text_fields = extract_text_fields(sources, text_field_rules, text_field_select, debug_queries)
+
+        templates = None
+        if search_templates:
+            templates = SearchTemplates(query_cls, text_fields)
+            templates.register(es_client, search_indexes)
+
         self.controllers = Controllers(
             search_indexes=search_indexes,
-            text_fields=extract_text_fields(sources, text_field_rules, text_field_select, debug_queries),
+            text_fields=text_fields,
             document_index=document_index,
             multi_match_type=multi_match_type,
             multi_match_operator=multi_match_operator,
             debug_queries=debug_queries,
-            query_cls=query_cls
+            query_cls=query_cls,
+            request_cache=request_cache,
+            date_rounding=date_rounding,
+            slow_query_log=slow_query_log,
+            suggest_fields=suggest_fields if suggest_fields is not None else extract_title_fields(sources),
+            routing=search_routing,
+            hedger=Hedger(hedge_percentile, hedge_max_extra_load) if hedge_percentile else None,
+            templates=templates
         )
 
         self.add_url_rule(
@@ -76,12 +174,30 @@ class APIESBlueprint(Blueprint):
             self.count_handler,
             methods=['GET']
         )
+        self.add_url_rule(
+            '/search/batch',
+            'search_batch_handler',
+            self.search_batch_handler,
+            methods=['POST']
+        )
         self.add_url_rule(
             '/search/<string:types>',
             'dynamic_search_handler',
             self.search_handler,
             methods=['GET']
         )
+        self.add_url_rule(
+            '/suggest/<string:types>',
+            'suggest_handler',
+            self.suggest_handler,
+            methods=['GET']
+        )
+        self.add_url_rule(
+            '/facets/<string:types>',
+            'facets_handler',
+            self.facets_handler,
+            methods=['GET']
+        )
         self.add_url_rule(
             '/download/<string:types>',
             'download',
@@ -90,14 +206,257 @@ class APIESBlueprint(Blueprint):
         )
 
         app.config['ES_CLIENT'] = es_client
-        self.json = demjson.JSON()
-        self.json.set_hook('decode_float', float)
+        self.fast_json = fast_json
+        self.export_slices = export_slices
+        self.export_workers = export_workers
+        self.export_max_slices = export_max_slices
+        self.export_batch_size = export_batch_size
+        self.search_timeout = search_timeout
+        self.search_batch_max_size = search_batch_max_size
+        self.search_preference = search_preference
+        self.cache = None
+        if cache_ttl is not None:
+            self.cache = ResponseCache(
+                cache_backend or MemoryCacheBackend(cache_max_entries),
+                cache_ttl,
+                stale_ttl=cache_stale_ttl,
+                stale_if_error=cache_stale_if_error
+            )
+        # Suggestions for short prefixes are the most common, and are cached separately
+        self.suggest_cache = None
+        self.suggest_cache_prefix_length = suggest_cache_prefix_length
+        if suggest_cache_ttl:
+            self.suggest_cache = ResponseCache(MemoryCacheBackend(suggest_cache_max_entries), suggest_cache_ttl)
+        if admission_limits or admission_client_limits:
+            self.admission = AdmissionController(admission_limits, admission_client_limits, admission_queue_timeout)
+            self.admission_client_key = admission_client_key
+            self.admission_retry_after = admission_retry_after
+            self.before_request(self.admit_request)
+            self.teardown_request(self.release_request)
+        # Profiling hooks are only installed when enabled, so they add no overhead otherwise
+        if profile_header or profile_rate:
+            self.profiler = RequestProfiler(profile_header, profile_token, profile_rate, profile_dir, profiler)
+            self.before_request(self.start_profile)
+            self.after_request(self.profile_stream)
+            self.teardown_request(self.stop_profile)
+        self.compression_encodings = []
+        if compression:
+            self.compression_encodings = available_encodings(None if compression is True else compression)
+            self.compression_min_size = compression_min_size
+            self.after_request(self.compress_response)
+        self._json = None
+
+        self.app = app
+        self.warmup = Warmup(self._warm_up_query, warmup_concurrency)
+        self.warmup_queries = warmup
+        if warmup is not None:
+            # Started in the background once the blueprint is registered, so it doesn't delay readiness
+            self.record_once(lambda state: self.warm_up())
+
+    @property
+    def json(self):
+        # Only needed for decoding count configs, so it's created (and demjson imported) on first use
+        if self._json is None:
+            import demjson3 as demjson
+
+            self._json = demjson.JSON()
+            self._json.set_hook('decode_float', float)
+        return self._json
+
+    def warm_up(self, queries=None):
+        """
+        Replays queries in the background, to warm up the ElasticSearch and response caches
+        (e.g. on startup, or after the indexes are swapped)
+
+        :param queries: A list of queries (or a JSONL file of queries), each with the parameters of a search request
+        (and its `types`) or of a count request (with its `config`) - by default, the configured warmup queries
+        :return: The background thread running the queries
+        """
+        queries = queries if queries is not None else self.warmup_queries
+        if isinstance(queries, str):
+            queries = load_warmup_log(queries)
+        return self.warmup.start(queries or [])
+
+    def _warm_up_query(self, query):
+        values = dict(query)
+        endpoint = values.pop('endpoint', 'count' if 'config' in values else 'search')
+        types = values.pop('types', None)
+        if not isinstance(types, (str, type(None))):
+            types = ','.join(types)
+        values = dict((k, v if isinstance(v, str) else json.dumps(v)) for k, v in values.items())
+        with self.app.test_request_context():
+            if endpoint == 'count':
+                path = url_for(self.name + '.simple_count_handler')
+            else:
+                path = url_for(self.name + '.dynamic_search_handler', types=types)
+        # Run the handler in the same way as an actual request, so its response is cached as well
+        with self.app.test_request_context(path, query_string=values):
+            g.apies_cache_refresh = True
+            if endpoint == 'count':
+                response = self.count_handler()
+            else:
+                response = self.search_handler(types)
+        return 'error' not in response.get_json()
+
+    def _split(self, value):
+        if not value:
+            return []
+        if isinstance(value, str):
+            value = value.split(',')
+        return [x.strip() for x in value if x]
+
+    def _search_params(self, values):
+        return dict(
+            term=values.get('q'),
+            filters=values.get('filter'),
+            lookup=values.get('lookup'),
+            term_context=values.get('context'),
+            extra=values.get('extra'),
+            from_date=values.get('from_date'),
+            to_date=values.get('to_date'),
+            size=values.get('size', 10),
+            offset=values.get('offset', 0),
+            sort_fields=values.get('order'),
+            highlight=self._split(values.get('highlight')),
+            snippets=self._split(values.get('snippets')),
+            match_type=values.get('match_type'),
+            match_operator=values.get('match_operator'),
+            collapse=values.get('collapse'),
+            collapse_inner=values.get('collapse_inner'),
+            score_threshold=int(values.get('minscore', 0)),
+            timeout=self._timeout(values),
+            preference=self._preference(),
+            two_phase=values.get('two_phase') not in (None, '', '0', 'false', False),
+        )
+
+    def _timeout(self, values):
+        # The request's deadline (in seconds), defaulting to (and at most) the configured one
+        timeout = values.get('timeout')
+        if timeout is None or timeout == '':
+            return self.search_timeout
+        timeout = float(timeout)
+        if not 0 < timeout < float('inf'):
+            raise ValueError('timeout must be a positive number of seconds')
+        if self.search_timeout is not None:
+            timeout = min(timeout, self.search_timeout)
+        return timeout
+
+    def _export_slices(self):
+        slices = int(request.values.get('slices', self.export_slices))
+        return max(1, min(slices, self.export_max_slices))
+
+    def _preference(self):
+        # The shard preference of the current request (per type, if configured per type)
+        if self.search_preference is None:
+            return None
+        if isinstance(self.search_preference, dict):
+            return dict(
+                (type_name, self._preference_value(key()))
+                for type_name, key in self.search_preference.items()
+            )
+        return self._preference_value(self.search_preference())
+
+    def _preference_value(self, key):
+        if not key:
+            return None
+        # Hashed, so that keys can't clash with ElasticSearch's special (`_`-prefixed) preference values
+        return hashlib.blake2b(str(key).encode('utf8'), digest_size=8).hexdigest()
 
     def search_handler(self, types):
         es_client = current_app.config['ES_CLIENT']
 
+        search_term = request.values.get('q')
+        try:
+            types_formatted = str(types).split(',')
+            params = self._search_params(request.values)
+            term = params.pop('term')
+            result = self._cached('search', lambda: self.controllers.search(
+                es_client, types_formatted, term, **params
+            ))
+        except Exception as e:
+            logger.exception('Error searching %s for types: %s ' % (search_term, str(types)))
+            result = {'error': str(e)}
+        return self._search_response(result)
+
+    def search_batch_handler(self):
+        es_client = current_app.config['ES_CLIENT']
+
+        searches = request.get_json(silent=True)
+        try:
+            if isinstance(searches, dict):
+                searches = searches.get('searches')
+            if not isinstance(searches, list):
+                raise ValueError('expected a list of searches')
+            if len(searches) > self.search_batch_max_size:
+                # The whole batch is admitted as a single search request, so it's kept small
+                response = jsonpify({'error': 'a batch may contain at most {} searches'.format(
+                    self.search_batch_max_size
+                )})
+                response.status_code = 400
+                return response
+            specs = []
+            for search in searches:
+                params = self._search_params(search)
+                params['types'] = self._split(search.get('types'))
+                specs.append(params)
+            result = dict(
+                results=self.controllers.search_batch(es_client, specs)
+            )
+        except Exception as e:
+            logger.exception('Error searching batch %r', searches)
+            result = {'error': str(e)}
+        return self._search_response(result)
+
+    def _search_response(self, result):
+        if not self.fast_json:
+            return jsonpify(result)
+        # Same as jsonpify, but encoded by orjson (which is several times faster for large result pages)
+        import orjson
+
+        body = orjson.dumps(result, default=fast_json_default, option=orjson.OPT_SORT_KEYS)
+        callback = request.args.get('callback')
+        if callback:
+            return current_app.response_class(
+                b''.join([callback.encode('utf8'), b'(', body, b');']),
+                mimetype='application/javascript'
+            )
+        return current_app.response_class(body, mimetype='application/json')
+
+    def suggest_handler(self, types):
+        es_client = current_app.config['ES_CLIENT']
+
+        search_term = (request.values.get('q') or '').strip()
+        try:
+            if not search_term:
+                result = dict(suggestions=[])
+            else:
+                types_formatted = str(types).split(',')
+                size = int(request.values.get('size', 10))
+                filters = request.values.get('filter')
+                timeout = self._timeout(request.values)
+                preference = self._preference()
+
+                def compute():
+                    return self.controllers.suggest(es_client, types_formatted, search_term,
+                                                    size=size, filters=filters, timeout=timeout,
+                                                    preference=preference)
+
+                if self.suggest_cache is not None and len(search_term) <= self.suggest_cache_prefix_length:
+                    key = json.dumps([types_formatted, search_term, size, filters], ensure_ascii=False)
+                    result = self.suggest_cache.get(key, compute, cacheable=lambda result: 'partial' not in result)
+                else:
+                    result = compute()
+        except Exception as e:
+            logger.exception('Error suggesting %s for types: %s ' % (search_term, str(types)))
+            result = {'error': str(e)}
+        return jsonpify(result)
+
+    def facets_handler(self, types):
+        es_client = current_app.config['ES_CLIENT']
+
         try:
             types_formatted = str(types).split(',')
+            fields = [x.strip() for x in request.values.get('fields', '').split(',') if x]
             filters = request.values.get('filter')
             lookup = request.values.get('lookup')
             search_term = request.values.get('q')
@@ -105,34 +464,25 @@ class APIESBlueprint(Blueprint):
             extra = request.values.get('extra')
             from_date = request.values.get('from_date')
             to_date = request.values.get('to_date')
-            size = request.values.get('size', 10)
-            offset = request.values.get('offset', 0)
-            order = request.values.get('order')
-            highlight = [x.strip() for x in request.values.get('highlight', '').split(',') if x]
-            snippets = [x.strip() for x in request.values.get('snippets', '').split(',') if x]
-            match_type = request.values.get('match_type')
-            match_operator = request.values.get('match_operator')
-            score_threshold = int(request.values.get('minscore', 0))
+            timeline = request.values.get('timeline', '1') not in ('0', 'false')
+            facet_size = int(request.values.get('facet_size', 100))
 
-            result = self.controllers.search(
+            result = self.controllers.facets(
                 es_client, types_formatted, search_term,
+                fields=fields,
                 from_date=from_date,
                 to_date=to_date,
-                size=size,
-                offset=offset,
                 filters=filters,
                 lookup=lookup,
                 term_context=term_context,
                 extra=extra,
-                score_threshold=score_threshold, 
-                sort_fields=order,
-                highlight=highlight,
-                snippets=snippets,
-                match_type=match_type,
-                match_operator=match_operator,
+                timeline=timeline,
+                facet_size=facet_size,
+                timeout=self._timeout(request.values),
+                preference=self._preference(),
             )
         except Exception as e:
-            logger.exception('Error searching %s for types: %s ' % (search_term, str(types)))
+            logger.exception('Error fetching facets %s for types: %s ' % (search_term, str(types)))
             result = {'error': str(e)}
         return jsonpify(result)
 
@@ -163,20 +513,43 @@ class APIESBlueprint(Blueprint):
             score_threshold = int(request.values.get('minscore', 0))
 
             # Get the query results
-            result = self.controllers.search(es_client,
-                                             types_formatted,
-                                             search_term,
-                                             from_date,
-                                             to_date,
-                                             size,
-                                             offset,
-                                             filters,
-                                             lookup,
-                                             term_context,
-                                             extra,
-                                             score_threshold=score_threshold,
-                                             sort_fields=order)
-
+            if request.values.get('export'):
+                # Fetch all results (up to `size`) using concurrent sliced scrolls
+                result = self.controllers.export(es_client,
+                                                 types_formatted,
+                                                 search_term,
+                                                 from_date=from_date,
+                                                 to_date=to_date,
+                                                 size=request.values.get('size'),
+                                                 filters=filters,
+                                                 lookup=lookup,
+                                                 term_context=term_context,
+                                                 extra=extra,
+                                                 score_threshold=score_threshold,
+                                                 sort_fields=order,
+                                                 slices=self._export_slices(),
+                                                 workers=self.export_workers,
+                                                 batch_size=self.export_batch_size)
+            else:
+                result = self.controllers.search(es_client,
+                                                 types_formatted,
+                                                 search_term,
+                                                 from_date=from_date,
+                                                 to_date=to_date,
+                                                 size=size,
+                                                 offset=offset,
+                                                 filters=filters,
+                                                 lookup=lookup,
+                                                 term_context=term_context,
+                                                 extra=extra,
+                                                 score_threshold=score_threshold,
+                                                 sort_fields=order)
+
+        except ValueError as e:
+            # e.g. an ordered export of too many slices
+            response = jsonpify({'error': str(e)})
+            response.status_code = 400
+            return response
         except Exception as e:
             logging.exception('Error searching %s for types: %s ' % (search_term, str(types)))
             result = {'error': str(e)}
@@ -192,13 +565,30 @@ class APIESBlueprint(Blueprint):
         # Get the file name and format from the query string, or give them default values
         file_format = request.values.get('file_format')
         if file_format == 'csv':
-            file = get_csv(result, column_mapping)
+            file = stream_with_context(iter_csv(result, column_mapping))
 
             # Make the response object
-            response = make_response(file)
+            response = current_app.response_class(file)
             response.headers["Content-Disposition"] = "attachment; filename={}".format(file_name + '.csv')
             response.headers["Content-type"] = 'text/csv'
 
+        elif file_format == 'ndjson':
+            file = stream_with_context(iter_ndjson(result))
+
+            # Make the response object
+            response = current_app.response_class(file)
+            response.headers["Content-Disposition"] = "attachment; filename={}".format(file_name + '.ndjson')
+            response.headers["Content-type"] = 'application/x-ndjson'
+
+        elif file_format == 'parquet':
+            file_stream = get_parquet(result, column_mapping, self.schemas)
+
+            # Make the response object
+            response = send_file(file_stream,
+                                 as_attachment=True,
+                                 mimetype='application/vnd.apache.parquet',
+                                 download_name=file_name + '.parquet')
+
         elif file_format == 'xls':
             file_stream = get_xls(result, column_mapping)
 
@@ -206,7 +596,7 @@ class APIESBlueprint(Blueprint):
             response = send_file(file_stream,
                                  as_attachment=True,
                                  mimetype='application/vnd.ms-excel',
-                                 attachment_filename=file_name + '.xlsx')
+                                 download_name=file_name + '.xls')
 
         else:
             file_stream = get_xlsx(result, column_mapping)
@@ -215,10 +605,94 @@ class APIESBlueprint(Blueprint):
             response = send_file(file_stream,
                                  as_attachment=True,
                                  mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                                 attachment_filename=file_name + '.xlsx')
+                                 download_name=file_name + '.xlsx')
 
         return response
 
+    def _cached(self, endpoint, compute):
+        if self.cache is None:
+            return compute()
+        key = json.dumps([
+            endpoint,
+            request.view_args,
+            sorted((k, v) for k, v in request.values.items(multi=True) if k not in ('callback', '_'))
+        ], ensure_ascii=False)
+        if g.get('apies_cache_refresh'):
+            # Warmup queries replace the cached responses
+            return self.cache.refresh(key, compute, cacheable=self._cacheable)
+        return self.cache.get(key, compute, cacheable=self._cacheable)
+
+    def _cacheable(self, result):
+        # Partial results are not cached
+        return all(
+            'timed_out' not in counts and 'error' not in counts and 'partial' not in counts
+            for counts in result.get('search_counts', {}).values()
+        )
+
+    def admit_request(self):
+        endpoint_class = ENDPOINT_CLASSES.get(request.endpoint.split('.')[-1], 'search')
+        try:
+            g.apies_admission = self.admission.admit(endpoint_class, self.admission_client_key())
+        except AdmissionRejected as e:
+            response = jsonpify({'error': str(e)})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(self.admission_retry_after)
+            return response
+
+    def release_request(self, exc):
+        token = g.pop('apies_admission', None)
+        if token is not None:
+            self.admission.release(token)
+
+    def start_profile(self):
+        if self.profiler.requested(request.headers):
+            g.apies_profile = self.profiler.start(request.endpoint.split('.')[-1])
+
+    def profile_stream(self, response):
+        # Streamed responses are generated after the request is torn down, so their profile is stopped
+        # only once they are fully sent
+        if response.is_streamed and 'apies_profile' in g:
+            response.response = self._profiled_stream(response.response, g.pop('apies_profile'))
+        return response
+
+    def _profiled_stream(self, chunks, active):
+        try:
+            yield from chunks
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self.profiler.stop(active)
+
+    def stop_profile(self, exc):
+        active = g.pop('apies_profile', None)
+        if active is not None:
+            self.profiler.stop(active)
+
+    def compress_response(self, response):
+        if response.status_code != 200 or 'Content-Encoding' in response.headers:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(self.compression_encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            # Compress chunked responses incrementally
+            compressed, chunks = compress_stream(response.response, encoding, self.compression_min_size)
+            response.response = chunks
+            response.direct_passthrough = False
+            if not compressed:
+                return response
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.compression_min_size:
+                return response
+            response.set_data(compress(data, encoding))
+
+        response.headers['Content-Encoding'] = encoding
+        return response
+
     def count_handler(self):
         es_client = current_app.config['ES_CLIENT']
 
@@ -230,9 +704,12 @@ class APIESBlueprint(Blueprint):
             to_date = request.values.get('to_date')
             term_context = request.values.get('context')
             extra = request.values.get('extra')
-            result = self.controllers.count(
-                es_client, search_term, from_date, to_date, config, term_context, extra
-            )
+            timeout = self._timeout(request.values)
+            preference = self._preference()
+            result = self._cached('count', lambda: self.controllers.count(
+                es_client, search_term, from_date, to_date, config, term_context, extra,
+                timeout=timeout, preference=preference
+            ))
         except Exception as e:
             logger.exception('Error counting with config %r', config)
             result = {'error': str(e)}
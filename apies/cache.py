@@ -0,0 +1,214 @@
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+from collections import OrderedDict
+
+from .logger import logger
+
+
+class MemoryCacheBackend():
+    """
+    An in-process LRU cache backend
+    """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: A (stored_at, value) tuple, or None if the key is not in the cache
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, stored_at, value):
+        with self.lock:
+            self.entries[key] = (stored_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class MmapCacheBackend():
+    """
+    A cache backend stored in a memory-mapped file, shared by all processes (e.g. gunicorn workers) using the same path.
+
+    The file is split into fixed-size slots, organized in sets of `ways` slots. Each key is stored in one of the slots
+    of its set, evicting the least recently used entry in that set. Responses larger than a slot are not cached.
+    Access to each set is serialized between processes using a lock on its byte range in the file.
+
+    Only the pages of the file which were written to take up memory, so slots are large enough for big result pages
+    without wasting memory on small responses.
+
+    :param path: Path of the cache file (preferably on a memory-backed filesystem, e.g. /dev/shm)
+    :param size: Total size (in bytes) of the cache
+    :param slot_size: Size (in bytes) of each slot
+    :param ways: Number of slots in each set
+    """
+
+    # Slot header: key digest, stored at, last accessed at, value length
+    HEADER = struct.Struct('<16sddI')
+
+    def __init__(self, path, size=256 * 1024 * 1024, slot_size=1024 * 1024, ways=8):
+        self.slot_size = slot_size
+        self.ways = ways
+        self.sets = max(1, size // (slot_size * ways))
+        size = self.sets * ways * slot_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        # File locks are held per process, so threads of the same process are serialized separately
+        self.lock = threading.Lock()
+
+    def _locate(self, key):
+        digest = hashlib.blake2b(key.encode('utf8'), digest_size=16).digest()
+        set_offset = (int.from_bytes(digest[:8], 'little') % self.sets) * self.ways * self.slot_size
+        return digest, set_offset
+
+    def _lock(self, set_offset, lock_type):
+        fcntl.lockf(self.fd, lock_type, self.ways * self.slot_size, set_offset)
+
+    def _slots(self, set_offset):
+        for way in range(self.ways):
+            offset = set_offset + way * self.slot_size
+            yield (offset,) + self.HEADER.unpack_from(self.map, offset)
+
+    def get(self, key):
+        digest, set_offset = self._locate(key)
+        with self.lock:
+            self._lock(set_offset, fcntl.LOCK_EX)
+            try:
+                for offset, slot_digest, stored_at, _, length in self._slots(set_offset):
+                    if slot_digest == digest and length > 0:
+                        self.HEADER.pack_into(self.map, offset, digest, stored_at, time.time(), length)
+                        start = offset + self.HEADER.size
+                        data = self.map[start:start + length]
+                        break
+                else:
+                    return None
+            finally:
+                self._lock(set_offset, fcntl.LOCK_UN)
+        return stored_at, json.loads(data)
+
+    def set(self, key, stored_at, value):
+        data = json.dumps(value).encode('utf8')
+        if len(data) > self.slot_size - self.HEADER.size:
+            logger.info('Not caching %s: %d bytes is larger than the slot size (%d bytes)',
+                        key, len(data), self.slot_size)
+            return
+        digest, set_offset = self._locate(key)
+        with self.lock:
+            self._lock(set_offset, fcntl.LOCK_EX)
+            try:
+                # Replace the key's slot if it exists, otherwise an empty slot or the least recently used one
+                target = target_accessed_at = None
+                for offset, slot_digest, _, accessed_at, _ in self._slots(set_offset):
+                    if slot_digest == digest:
+                        target = offset
+                        break
+                    # Empty slots were never accessed, so they are picked first
+                    if target is None or accessed_at < target_accessed_at:
+                        target, target_accessed_at = offset, accessed_at
+                start = target + self.HEADER.size
+                self.map[start:start + len(data)] = data
+                self.HEADER.pack_into(self.map, target, digest, stored_at, time.time(), len(data))
+            finally:
+                self._lock(set_offset, fcntl.LOCK_UN)
+
+
+class ResponseCache():
+    """
+    Caches computed responses, serving stale copies while refreshing them or when refreshing them fails.
+
+    :param backend: The cache backend, storing (stored_at, value) entries by key
+    :param ttl: Time (in seconds) a response is fresh
+    :param stale_ttl: Time (in seconds) after expiring that a stale response is served, while it's refreshed in the
+    background
+    :param stale_if_error: Time (in seconds) after expiring that a stale response is served if refreshing it fails
+    (or returns a response which may not be cached, e.g. a partial one)
+    """
+
+    def __init__(self, backend, ttl, stale_ttl=0, stale_if_error=0):
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.stale_if_error = stale_if_error
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def get(self, key, compute, cacheable=None):
+        """
+        :param key: The cache key of the response
+        :param compute: A function computing the response
+        :param cacheable: A function checking whether a computed response may be cached
+        :return: The response - stale responses are marked with `stale: true`
+        """
+        entry = self.backend.get(key)
+        if entry is not None:
+            stored_at, value = entry
+            age = time.time() - stored_at
+            if age < self.ttl:
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self._refresh_in_background(key, compute, cacheable)
+                return dict(value, stale=True)
+
+        stale = entry is not None and time.time() - entry[0] < self.ttl + self.stale_if_error
+        try:
+            value = compute()
+        except Exception:
+            if stale:
+                logger.exception('Serving stale response for %s', key)
+                return dict(entry[1], stale=True)
+            raise
+        if self._store(key, value, cacheable):
+            return value
+        if stale:
+            # e.g. some of the sub-searches failed while nodes are restarting
+            logger.warning('Serving stale response for %s instead of a partial one', key)
+            return dict(entry[1], stale=True)
+        return value
+
+    def refresh(self, key, compute, cacheable=None):
+        """
+        Computes the response and caches it, regardless of its cached copy
+        """
+        value = compute()
+        self._store(key, value, cacheable)
+        return value
+
+    def _store(self, key, value, cacheable):
+        if cacheable is None or cacheable(value):
+            self.backend.set(key, time.time(), value)
+            return True
+        return False
+
+    def _refresh_in_background(self, key, compute, cacheable):
+        # Only one refresh of each key at a time
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                self.refresh(key, compute, cacheable)
+            except Exception:
+                logger.exception('Failed to refresh %s', key)
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
@@ -1,3 +1,8 @@
+import heapq
+import itertools
+import time
+
+from .export import sliced_scroll, SortKey, sort_directions
 from .logger import logger
 from .query import Query
 
@@ -12,7 +17,14 @@ class Controllers():
                  multi_match_type='most_fields',
                  multi_match_operator='and',
                  debug_queries=False,
-                 query_cls=Query):
+                 query_cls=Query,
+                 request_cache=False,
+                 date_rounding=None,
+                 slow_query_log=None,
+                 suggest_fields=None,
+                 routing=None,
+                 hedger=None,
+                 templates=None):
 
         self.text_fields = text_fields
         self.search_indexes = search_indexes
@@ -21,6 +33,13 @@ class Controllers():
         self.multi_match_operator = multi_match_operator
         self.debug_queries = debug_queries
         self.query_cls = query_cls
+        self.request_cache = request_cache
+        self.date_rounding = date_rounding
+        self.slow_query_log = slow_query_log
+        self.suggest_fields = suggest_fields or {}
+        self.routing = routing
+        self.hedger = hedger
+        self.templates = templates
 
     # REPLACEMENTS
     def _do_replacements(self, value, replacements):
@@ -113,7 +132,175 @@ class Controllers():
                highlight=None,
                snippets=None,
                match_type=None,
-               match_operator=None):
+               match_operator=None,
+               collapse=None,
+               collapse_inner=None,
+               timeout=None,
+               preference=None,
+               two_phase=False):
+        params = dict(
+            from_date=from_date,
+            to_date=to_date,
+            size=size,
+            offset=offset,
+            filters=filters,
+            lookup=lookup,
+            term_context=term_context,
+            extra=extra,
+            score_threshold=score_threshold,
+            sort_fields=sort_fields,
+            highlight=highlight,
+            snippets=snippets,
+            match_type=match_type,
+            match_operator=match_operator,
+            collapse=collapse,
+            collapse_inner=collapse_inner,
+            timeout=timeout,
+            preference=preference
+        )
+        if two_phase and not collapse:
+            return self._two_phase_search(es_client, types, term, params)
+
+        query = self._search_query(types, term, **params)
+
+        # Execute the query
+        results = self._run(es_client, query, 'search', dict(params, types=types, term=term))
+        return self._search_results(query, results, highlight, snippets)
+
+    def _two_phase_search(self, es_client, types, term, params):
+        """
+        Ranks the results of all types together, fetching only the ids of the candidates from each type,
+        and then the sources (and highlights) of the results in the requested page.
+        """
+        size = int(params['size'])
+        offset = int(params['offset'])
+        # Both phases share the request's deadline
+        deadline = None
+        if params['timeout'] is not None:
+            deadline = time.perf_counter() + params['timeout']
+
+        # Phase one: the ids and sort values of the top results of each type
+        query = self._search_query(types, term, **dict(params, size=size + offset, offset=0,
+                                                       highlight=None, snippets=None))
+        query.apply_source({})
+        results = self._run(es_client, query, 'search', dict(params, types=types, term=term, phase=1))
+
+        # Each type's hits are already sorted, so they're merged according to their sort values
+        directions = sort_directions(query.q[query.types[0]].get('sort', []))
+        type_hits = []
+        for _type, result in zip(query.searched_types(), results['responses']):
+            type_hits.append([(_type, hit) for hit in result.get('hits', {}).get('hits', [])])
+        ranked = list(itertools.islice(
+            heapq.merge(*type_hits, key=lambda item: SortKey(item[1].get('sort'), directions)),
+            offset, offset + size
+        ))
+
+        # Phase two: the full hits of the requested page
+        hits = []
+        statuses = dict()
+        if ranked:
+            ids = dict()
+            for _type, hit in ranked:
+                ids.setdefault(_type, []).append(hit['_id'])
+            timeout = params['timeout']
+            if deadline is not None:
+                timeout = deadline - time.perf_counter()
+            if timeout is not None and timeout < 0.001:
+                statuses = dict((_type, dict(timed_out=True)) for _type in ids)
+            else:
+                # All types are searched again (types without results in the page match no ids),
+                # so that the filters and lookups of the first phase apply as they are
+                page_query = self._search_query(types, term, **dict(params, size=max(map(len, ids.values())),
+                                                                    offset=0, timeout=timeout))
+                page_query.apply_ids(ids)
+                page_results = self._run(es_client, page_query, 'search',
+                                         dict(params, types=types, term=term, phase=2))
+                fetched = dict()
+                for _type, result in zip(page_query.searched_types(), page_results['responses']):
+                    status = self._partial_status(result)
+                    if status:
+                        statuses[_type] = status
+                    for hit in result.get('hits', {}).get('hits', []):
+                        hit['_type'] = _type
+                        fetched[(_type, hit['_id'])] = hit
+                # Documents which were removed since the first phase are skipped
+                hits = [fetched[(_type, hit['_id'])] for _type, hit in ranked if (_type, hit['_id']) in fetched]
+
+        ret = self._search_results(query, results, params['highlight'], params['snippets'], ranked_hits=hits)
+        for _type, status in statuses.items():
+            ret['search_counts'][_type].update(status)
+            ret['search_counts']['_current']['partial'] = True
+        return ret
+
+    def search_batch(self, es_client, searches):
+        """
+        Performs several searches using a single msearch request
+
+        :param searches: A list of dicts, each containing the `types` and `term` of a search,
+        along with any other keyword argument of `search`
+        :return list: The result of each search, in order (or an error, for searches which failed to build)
+        """
+        queries = []
+        for search in searches:
+            search = dict(search)
+            # Two-phase searches need two round trips, so batched searches are always interleaved
+            search.pop('two_phase', None)
+            try:
+                queries.append((self._search_query(search.pop('types'), search.pop('term', None), **search), search))
+            except Exception as e:
+                logger.exception('Error building search %r', search)
+                queries.append((None, dict(error=str(e))))
+
+        built = [query for query, _ in queries if query is not None]
+        results = iter(self._run_batch(es_client, built, 'search_batch', searches) if built else [])
+
+        ret = []
+        for query, search in queries:
+            if query is None:
+                ret.append(search)
+            else:
+                ret.append(self._search_results(query, next(results), search.get('highlight'), search.get('snippets')))
+        return ret
+
+    def _run(self, es_client, query, endpoint, params):
+        start = time.perf_counter()
+        results = query.run(es_client, self.debug_queries, self.request_cache, self.hedger, self.templates)
+        if self.slow_query_log is not None:
+            self.slow_query_log.check(es_client, endpoint, params, [query], [results],
+                                      time.perf_counter() - start, self.request_cache)
+        return results
+
+    def _run_batch(self, es_client, queries, endpoint, params):
+        start = time.perf_counter()
+        results = self.query_cls.run_batch(es_client, queries, self.debug_queries, self.request_cache,
+                                           self.hedger, self.templates)
+        if self.slow_query_log is not None:
+            self.slow_query_log.check(es_client, endpoint, params, queries, results,
+                                      time.perf_counter() - start, self.request_cache)
+        return results
+
+    def _search_query(self,
+                      types,
+                      term,
+                      *,
+                      from_date=None,
+                      to_date=None,
+                      size=10,
+                      offset=0,
+                      filters=None,
+                      lookup=None,
+                      term_context=None,
+                      extra=None,
+                      score_threshold=0,
+                      sort_fields=None,
+                      highlight=None,
+                      snippets=None,
+                      match_type=None,
+                      match_operator=None,
+                      collapse=None,
+                      collapse_inner=None,
+                      timeout=None,
+                      preference=None):
         search_indexes = self._validate_types(types)
 
         query = self.query_cls(search_indexes)
@@ -145,6 +332,9 @@ class Controllers():
         # Apply pagination
         query = query.apply_pagination(size, offset)
 
+        # Apply result collapsing
+        query = query.apply_collapse(collapse, collapse_inner)
+
         # Apply highlighting
         if term and (highlight or snippets):
             query = query.apply_highlighting(term, highlight, snippets)
@@ -156,48 +346,92 @@ class Controllers():
         query = query.apply_exact_total()
 
         # Apply the time range
-        query = query.apply_time_range(from_date, to_date)
+        query = query.apply_time_range(from_date, to_date, self.date_rounding)
 
-        # Execute the query
-        results = query.run(es_client, self.debug_queries)
+        # Apply the deadline
+        query = query.apply_timeout(timeout)
+
+        # Apply the shard preference and routing
+        query = query.apply_preference(preference, self.routing)
+
+        return query
+
+    def _hit_result(self, hit, highlight, snippets):
+        ret = self._hit_base_result(hit, highlight, snippets)
+        if 'inner_hits' in hit:
+            # The other documents of a collapsed result
+            ret['collapsed'] = [
+                inner_hit['_source']
+                for inner_hit in hit['inner_hits']['collapsed']['hits']['hits']
+            ]
+        return ret
+
+    def _hit_base_result(self, hit, highlight, snippets):
+        default_sort_score = (0,)
+        if 'highlight' in hit:
+            return dict(
+                source=self._merge_highlight_into_source(
+                    hit['_source'],
+                    hit['highlight'],
+                    highlight,
+                    snippets
+                ),
+                type=hit['_type'],
+                score=hit['_score'] or hit.get('sort', default_sort_score)[0]
+            )
+        return dict(
+            source=hit['_source'],
+            type=hit['_type'],
+            score=hit['_score'] or hit.get('sort', default_sort_score)[0]
+        )
+
+    def _partial_status(self, result):
+        # Sub-searches which timed out or failed are reported instead of failing the whole request
+        status = dict()
+        if result.get('timed_out'):
+            status['timed_out'] = True
+        if 'error' in result:
+            status['error'] = result['error']
+        return status
+
+    def _search_results(self, query, results, highlight, snippets, ranked_hits=None):
+        """
+        :param ranked_hits: The hits to return, in order (by default, the hits of all types are interleaved)
+        """
         query_results = results['responses']
         hits = []
         total_overall = 0
+        partial = False
         search_counts = dict()
-        for _type, result in zip(query.types, query_results):
+        for _type, result in zip(query.searched_types(), query_results):
             result_hits = result.get('hits', {})
             for i, hit in enumerate(result_hits.get('hits', [])):
                 hit['_type'] = _type
                 hits.append((i, hit))
             count = result_hits.get('total', {}).get('value', 0)
+            if 'collapse:total' in result.get('aggregations', {}):
+                # Collapsed results are counted by their distinct values
+                count = result['aggregations']['collapse:total']['value']
             total_overall += count
-            search_counts[_type] = dict(total_overall=count)
+            status = self._partial_status(result)
+            search_counts[_type] = dict(total_overall=count, **status)
+            partial = partial or len(status) > 0
             if 'hits' not in result or 'hits' not in result['hits']:
                 logger.warning('no hits element for query for type %s: %r', _type, result)
         hits = [j[1] for j in sorted(hits, key=lambda i: i[0])]
+        if ranked_hits is not None:
+            hits = ranked_hits
 
-        default_sort_score = (0,)
         search_results = [
-            dict(
-                source=self._merge_highlight_into_source(
-                    hit['_source'],
-                    hit['highlight'],
-                    highlight,
-                    snippets
-                ),
-                type=hit['_type'],
-                score=hit['_score'] or hit.get('sort', default_sort_score)[0]
-            ) if 'highlight' in hit else dict(
-                source=hit['_source'],
-                type=hit['_type'],
-                score=hit['_score'] or hit.get('sort', default_sort_score)[0]
-            )
+            self._hit_result(hit, highlight, snippets)
             for hit in hits
         ]
 
         search_counts['_current'] = dict(
             total_overall=total_overall
         )
+        if partial:
+            search_counts['_current']['partial'] = True
         ret = dict(
             search_counts=search_counts,
             search_results=search_results
@@ -205,13 +439,63 @@ class Controllers():
         query.process_extra(ret, results)
         return ret
 
-    def count(self, es_client, term, from_date, to_date, config, term_context, extra):
-        counts = {}
+    def export(self,
+               es_client,
+               types,
+               term,
+               *,
+               from_date=None,
+               to_date=None,
+               size=None,
+               filters=None,
+               lookup=None,
+               term_context=None,
+               extra=None,
+               score_threshold=0,
+               sort_fields=None,
+               slices=4,
+               workers=8,
+               batch_size=1000):
+        """
+        Performs a search and fetches all of its results, using concurrent sliced scrolls
+
+        Results are returned in the requested order if `sort_fields` is set, and in no particular order otherwise.
+
+        :param size: Maximum number of results to fetch (all results, if not set)
+        :param slices: Number of slices to split the search of each type into
+        :param workers: Maximum number of slices to fetch concurrently
+        :param batch_size: Number of results to fetch in each request
+        :return dict: Similar to the result of `search`, with `search_results` being an iterator
+        """
+        ordered = sort_fields is not None
+        query = self._search_query(
+            types, term,
+            from_date=from_date,
+            to_date=to_date,
+            size=batch_size,
+            filters=filters,
+            lookup=lookup,
+            term_context=term_context,
+            extra=extra,
+            score_threshold=score_threshold,
+            sort_fields=sort_fields if ordered else '_doc'
+        )
+        query.log_query(self.debug_queries)
+        hits = sliced_scroll(es_client, query,
+                             slices=slices, workers=workers, batch_size=batch_size, ordered=ordered)
+        if size is not None:
+            hits = itertools.islice(hits, int(size))
+        return dict(
+            search_results=(self._hit_result(hit, None, None) for hit in hits)
+        )
+
+    def count(self, es_client, term, from_date, to_date, config, term_context, extra, timeout=None,
+              preference=None):
+        queries = []
         for item in config:
             doc_types = item['doc_types']
             search_indexes = self._validate_types(doc_types)
             filters = item['filters']
-            id = item['id']
             query_results = self.query_cls(search_indexes)
             if term:
                 query_results = query_results.apply_term(
@@ -225,24 +509,154 @@ class Controllers():
             query_results = query_results\
                 .apply_filters(filters)\
                 .apply_pagination(0, 0)\
-                .apply_time_range(from_date, to_date)\
-                .apply_exact_total()
+                .apply_time_range(from_date, to_date, self.date_rounding)\
+                .apply_exact_total()\
+                .apply_timeout(timeout)\
+                .apply_preference(preference, self.routing)
 
             # Apply extra processing
             if extra:
                 query_results = query_results.apply_extra(extra)
-
-            query_results = query_results.run(es_client, self.debug_queries)
+            queries.append(query_results)
+
+        # All items are counted in a single msearch, so they share the request's deadline
+        results = []
+        if queries:
+            results = self._run_batch(es_client, queries, 'count',
+                                      dict(config=config, term=term, from_date=from_date, to_date=to_date,
+                                           term_context=term_context, extra=extra))
+        counts = {}
+        for item, query_results in zip(config, results):
+            id = item['id']
             counts[id] = dict(
                 total_overall=sum(
-                    results['hits']['total']['value']
-                    for results in query_results['responses']
+                    response.get('hits', {}).get('total', {}).get('value', 0)
+                    for response in query_results['responses']
                 )
             )
+            for response in query_results['responses']:
+                counts[id].update(self._partial_status(response))
         return dict(
             search_counts=counts
         )
 
+    def facets(self,
+               es_client,
+               types,
+               term,
+               *,
+               fields=None,
+               from_date=None,
+               to_date=None,
+               filters=None,
+               lookup=None,
+               term_context=None,
+               extra=None,
+               timeline=True,
+               facet_size=100,
+               timeout=None,
+               preference=None):
+        search_indexes = self._validate_types(types)
+
+        query = self.query_cls(search_indexes)
+        if term:
+            query = query.apply_term(
+                term, self.text_fields,
+                multi_match_type=self.multi_match_type,
+                multi_match_operator=self.multi_match_operator)
+
+        if term_context:
+            query = query.apply_term_context(term_context, self.text_fields)
+
+        query = query\
+            .apply_filters(filters)\
+            .apply_lookup(lookup)\
+            .apply_pagination(0, 0)\
+            .apply_time_range(from_date, to_date, self.date_rounding)\
+            .apply_exact_total()\
+            .apply_timeout(timeout)\
+            .apply_preference(preference, self.routing)
+
+        # Terms aggregations for the requested fields, and the month timeline
+        if fields:
+            query = query.apply_terms_aggregates(fields, facet_size)
+        if timeline:
+            query = query.apply_month_aggregates()
+
+        # Apply extra processing
+        query = query.apply_extra(extra)
+
+        # All types are aggregated in a single msearch
+        results = self._run(es_client, query, 'facets',
+                            dict(types=types, term=term, fields=fields, from_date=from_date, to_date=to_date,
+                                 filters=filters, lookup=lookup, term_context=term_context, extra=extra))
+        facets = dict()
+        for _type, result in zip(query.searched_types(), results['responses']):
+            aggregations = result.get('aggregations', {})
+            type_facets = dict(
+                total_overall=result.get('hits', {}).get('total', {}).get('value', 0),
+                fields=dict(
+                    (field, [
+                        [bucket['key'], bucket['doc_count']]
+                        for bucket in aggregations.get('facet:' + field, {}).get('buckets', [])
+                    ])
+                    for field in fields or []
+                ),
+                **self._partial_status(result)
+            )
+            if timeline:
+                type_facets['timeline'] = [
+                    [bucket['key'], bucket['doc_count']]
+                    for bucket in aggregations.get('timeline', {}).get('buckets', [])
+                ]
+            if 'aggregations' not in result:
+                logger.warning('no aggregations element for query for type %s: %r', _type, result)
+            facets[_type] = type_facets
+
+        ret = dict(
+            facets=facets
+        )
+        query.process_extra(ret, results)
+        return ret
+
+    def suggest(self, es_client, types, term, *, size=10, filters=None, timeout=None, preference=None):
+        """
+        Performs a lightweight prefix search, for autocompletion
+
+        :param size: Maximum number of suggestions to return (over all types)
+        :return dict: The best matching documents, each with its id, type, score and suggestion fields
+        """
+        search_indexes = self._validate_types(types)
+
+        query = self.query_cls(search_indexes)\
+            .apply_suggest(term, self.text_fields)\
+            .apply_filters(filters)\
+            .apply_source(self.suggest_fields)\
+            .apply_pagination(size, 0)\
+            .apply_timeout(timeout)\
+            .apply_preference(preference, self.routing)
+
+        results = self._run(es_client, query, 'suggest',
+                            dict(types=types, term=term, size=size, filters=filters))
+        hits = []
+        partial = False
+        for _type, result in zip(query.searched_types(), results['responses']):
+            partial = partial or len(self._partial_status(result)) > 0
+            for hit in result.get('hits', {}).get('hits', []):
+                hits.append(dict(
+                    id=hit['_id'],
+                    type=_type,
+                    score=hit['_score'],
+                    source=hit.get('_source', {})
+                ))
+        hits.sort(key=lambda hit: -(hit['score'] or 0))
+
+        ret = dict(
+            suggestions=hits[:int(size)]
+        )
+        if partial:
+            ret['partial'] = True
+        return ret
 
     def get_document(self, es_client, doc_id, doc_type=None):
         try:
@@ -251,6 +665,8 @@ class Controllers():
                 types = [doc_type]
                 types = self._validate_types(types)
                 index = types[doc_type]
+                if isinstance(index, tuple):
+                    es_client, index = index
             logger.debug('FETCH %r in %s (%r)', doc_id, index, doc_type)
             result = es_client.get(index=index, id=doc_id)
             return result.get('_source')
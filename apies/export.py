@@ -0,0 +1,165 @@
+import heapq
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .logger import logger
+
+
+# Marks the end of a slice in the merge queues
+DONE = object()
+
+
+class SortKey():
+    """
+    Compares hits by their sort values, according to the sort directions of the query
+    """
+
+    __slots__ = ('values', 'directions')
+
+    def __init__(self, values, directions):
+        self.values = values or []
+        self.directions = directions
+
+    def __lt__(self, other):
+        for value, other_value, direction in zip(self.values, other.values, self.directions):
+            if value == other_value:
+                continue
+            # Missing values are sorted last
+            if value is None:
+                return False
+            if other_value is None:
+                return True
+            if direction == 'desc':
+                return value > other_value
+            return value < other_value
+        return False
+
+    def __eq__(self, other):
+        # Equal keys are merged in the order of their iterators
+        return self.values == other.values
+
+
+def sort_directions(sort):
+    directions = []
+    for item in sort:
+        if isinstance(item, str):
+            directions.append('desc' if item == '_score' else 'asc')
+        else:
+            field, spec = next(iter(item.items()))
+            if isinstance(spec, dict):
+                spec = spec.get('order', 'desc' if field == '_score' else 'asc')
+            directions.append(spec)
+    return directions
+
+
+def _put(out, item, stopped):
+    # Blocks while the queue is full, unless the export was stopped
+    while not stopped.is_set():
+        try:
+            out.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _scroll_slice(es_client, index, body, _type, scroll, out, stopped):
+    scroll_id = None
+    try:
+        response = es_client.search(index=index, body=body, scroll=scroll)
+        while not stopped.is_set():
+            scroll_id = response.get('_scroll_id')
+            hits = response['hits']['hits']
+            if len(hits) == 0:
+                break
+            for hit in hits:
+                hit['_type'] = _type
+            if not _put(out, hits, stopped):
+                break
+            response = es_client.scroll(scroll_id=scroll_id, scroll=scroll)
+    except Exception as e:
+        logger.exception('Error exporting slice %r of %s', body.get('slice'), index)
+        _put(out, e, stopped)
+    finally:
+        if scroll_id is not None:
+            try:
+                es_client.clear_scroll(scroll_id=scroll_id)
+            except Exception:
+                logger.warning('Failed to clear scroll for %s', index)
+        _put(out, DONE, stopped)
+
+
+def _drain(out, count):
+    remaining = count
+    while remaining > 0:
+        item = out.get()
+        if item is DONE:
+            remaining -= 1
+        elif isinstance(item, Exception):
+            raise item
+        else:
+            yield from item
+
+
+def sliced_scroll(es_client, query, slices=4, workers=8, batch_size=1000, ordered=False, scroll='5m'):
+    """
+    Fetches all the hits of a query, splitting each type's search into slices which are scrolled concurrently
+
+    :param es_client: The ElasticSearch client
+    :param query: The Query to export
+    :param slices: Number of slices to split each type's search into
+    :param workers: Maximum number of slices fetched concurrently
+    :param batch_size: Number of hits to fetch in each scroll request
+    :param ordered: Whether hits should be merged according to the query's sort order
+    (in which case all slices are fetched concurrently, so each type is split into fewer slices if needed)
+    :param scroll: How long ElasticSearch should keep each scroll context alive between requests
+    :return: An iterator over the hits (each with its `_type`)
+    """
+    types = [
+        (_type, index, client)
+        for _type, index, client in zip(query.types, query.indexes, query.clients)
+        if _type in query.filtered_type_names
+    ]
+    if ordered and types:
+        if len(types) > workers:
+            raise ValueError('an ordered export of {} types requires more than {} workers'.format(len(types), workers))
+        slices = max(1, min(slices, workers // len(types)))
+    tasks = []
+    for _type, index, client in types:
+        for slice_id in range(slices):
+            body = dict(query.q[_type], size=batch_size)
+            body.pop('from', None)
+            if slices > 1:
+                body['slice'] = dict(id=slice_id, max=slices)
+            tasks.append((client or es_client, index, body, _type))
+    return _scroll_tasks(tasks, workers, ordered, scroll)
+
+
+def _scroll_tasks(tasks, workers, ordered, scroll):
+    if len(tasks) == 0:
+        return
+
+    stopped = threading.Event()
+    if ordered:
+        outs = [queue.Queue(maxsize=2) for _ in tasks]
+    else:
+        outs = [queue.Queue(maxsize=2 * workers)] * len(tasks)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = []
+    try:
+        for (client, index, body, _type), out in zip(tasks, outs):
+            futures.append(executor.submit(_scroll_slice, client, index, body, _type, scroll, out, stopped))
+        if ordered:
+            directions = sort_directions(tasks[0][2].get('sort', []))
+            yield from heapq.merge(*[_drain(out, 1) for out in outs],
+                                   key=lambda hit: SortKey(hit.get('sort'), directions))
+        else:
+            yield from _drain(outs[0], len(tasks))
+    finally:
+        stopped.set()
+        # Slices which haven't started yet aren't scrolled at all
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
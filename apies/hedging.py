@@ -0,0 +1,113 @@
+import json
+import threading
+import time
+import uuid
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+from .logger import logger
+
+
+class Hedger():
+    """
+    Sends a duplicate (hedged) msearch request, when the original one takes longer than most requests.
+
+    The hedged request is sent with a different shard preference, so it's likely to be served by other shard copies,
+    and the first response to arrive is used. The other request can't be aborted once sent, so its response is
+    discarded when it arrives.
+
+    :param percentile: The percentile of recent latencies after which a request is hedged
+    :param max_extra_load: Maximum fraction of requests which are hedged
+    :param initial_delay: Delay (in seconds) after which requests are hedged, until enough latencies are recorded
+    :param min_delay: Minimal delay (in seconds) after which a request is hedged
+    :param window: Number of recent latencies to compute the percentile of
+    :param workers: Maximum number of requests in flight
+    """
+
+    MIN_SAMPLES = 20
+    # The delay is recomputed after this many new latencies are recorded
+    UPDATE_INTERVAL = 50
+    # Maximum number of hedges which can be accumulated, for bursts of slow requests
+    MAX_BUDGET = 10
+
+    def __init__(self, percentile=95, max_extra_load=0.05, initial_delay=0.1, min_delay=0.005,
+                 window=1000, workers=64):
+        self.percentile = percentile
+        self.max_extra_load = max_extra_load
+        self.min_delay = min_delay
+        self.delay = initial_delay
+        self.latencies = deque(maxlen=window)
+        self.recorded = 0
+        self.budget = 1.0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='apies-hedging')
+
+    def _record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.recorded += 1
+            if len(self.latencies) >= self.MIN_SAMPLES and self.recorded % self.UPDATE_INTERVAL == 0:
+                latencies = sorted(self.latencies)
+                index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+                self.delay = max(self.min_delay, latencies[index])
+
+    def _take_budget(self):
+        # Each request adds to the hedging budget, and each hedge uses one request's worth of it
+        with self.lock:
+            if self.budget >= 1:
+                self.budget -= 1
+                return True
+            return False
+
+    def _add_budget(self):
+        with self.lock:
+            self.budget = min(self.MAX_BUDGET, self.budget + self.max_extra_load)
+
+    @staticmethod
+    def hedged_body(body):
+        """
+        :return: The msearch body, with a new shard preference for all sub-searches
+        """
+        preference = uuid.uuid4().hex
+        lines = body.split('\n')
+        for i in range(0, len(lines) - 1, 2):
+            header = json.loads(lines[i])
+            header['preference'] = preference
+            lines[i] = json.dumps(header, sort_keys=True)
+        return '\n'.join(lines)
+
+    def run(self, send, body):
+        """
+        :param send: A function sending an msearch body and returning its response
+        :param body: The msearch body
+        :return: The first response
+        """
+        self._add_budget()
+        start = time.perf_counter()
+        original = self.executor.submit(send, body)
+        try:
+            result = original.result(timeout=self.delay)
+            self._record(time.perf_counter() - start)
+            return result
+        except FuturesTimeoutError:
+            pass
+
+        if not self._take_budget():
+            result = original.result()
+            self._record(time.perf_counter() - start)
+            return result
+
+        logger.debug('Hedging msearch after %.3f seconds', self.delay)
+        hedged = self.executor.submit(send, self.hedged_body(body))
+        pending = {original, hedged}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # A failed request is only reported if the other one fails as well
+            succeeded = [future for future in done if future.exception() is None]
+            if succeeded or not pending:
+                for other in pending:
+                    other.cancel()
+                self._record(time.perf_counter() - start)
+                return (succeeded or list(done))[0].result()
@@ -0,0 +1,91 @@
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import random
+import time
+import uuid
+
+from contextlib import contextmanager, ExitStack
+
+from .logger import logger
+
+
+profile_logger = logger.getChild('profiles')
+
+
+@contextmanager
+def cprofile_request(name, profile_dir=None):
+    """
+    Profiles a request using cProfile.
+
+    The stats are stored in `profile_dir` (to be read with `pstats` or e.g. snakeviz), or logged if not set.
+    """
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Only one deterministic profiler can be active at a time (in Python 3.12+)
+        profile_logger.warning('Not profiling %s: another profiler is active', name)
+        yield
+        return
+    try:
+        yield
+    finally:
+        profile.disable()
+        if profile_dir:
+            filename = os.path.join(profile_dir, '{}.prof'.format(name))
+            profile.dump_stats(filename)
+            profile_logger.info('PROFILE stored in %s', filename)
+        else:
+            out = io.StringIO()
+            pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(40)
+            profile_logger.info('PROFILE %s\n%s', name, out.getvalue())
+
+
+class RequestProfiler():
+    """
+    Profiles requests which ask for it (using an authorized header), and a random sample of all requests.
+
+    :param header: The request header turning on profiling for a request
+    :param token: The value of the header authorizing profiling (required when `header` is set)
+    :param rate: Fraction of requests to profile
+    :param profile_dir: Directory to store profiles in (if not set, profiles are logged)
+    :param profiler: A callable returning a context manager which profiles the code it wraps, given the name of
+    the profile (by default, profiles are made using cProfile)
+    """
+
+    def __init__(self, header=None, token=None, rate=0.0, profile_dir=None, profiler=None):
+        # Profiling is expensive (and profiles are stored), so it may not be turned on by any client
+        if header is not None and not token:
+            raise ValueError('profile_token is required when profile_header is set')
+        self.header = header
+        self.token = token
+        self.rate = rate
+        self.profiler = profiler or (lambda name: cprofile_request(name, profile_dir))
+
+    def requested(self, headers):
+        if self.header is not None:
+            value = headers.get(self.header)
+            if value and hmac.compare_digest(value.encode('utf8'), self.token.encode('utf8')):
+                return True
+        return self.rate > 0 and random.random() < self.rate
+
+    def start(self, endpoint):
+        """
+        :return: The active profile, to pass to `stop` when the request is done
+        """
+        name = '{}-{}-{}'.format(time.strftime('%Y%m%d%H%M%S'), endpoint, uuid.uuid4().hex[:8])
+        active = ExitStack()
+        try:
+            active.enter_context(self.profiler(name))
+        except Exception:
+            profile_logger.exception('Failed to start profiling %s', name)
+        return active
+
+    def stop(self, active):
+        try:
+            active.close()
+        except Exception:
+            profile_logger.exception('Failed to store profile')
@@ -1,26 +1,168 @@
-import demjson3 as demjson
 import json
-from elasticsearch import Elasticsearch
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch import Elasticsearch, ConnectionTimeout
 
 from .logger import logger
 
 
+# Date-range rounding units: the length of the ISO date prefix to keep and the date math rounding unit
+DATE_ROUNDING = dict(
+    year=(4, 'y'),
+    month=(7, 'M'),
+    day=(10, 'd'),
+    hour=(13, 'h'),
+    minute=(16, 'm'),
+)
+
+# Number of compiled filter and lookup parameters to keep
+COMPILED_COMPLEX_CACHE_SIZE = 1024
+
+# Time (in seconds) the client waits past a search's timeout, to allow ElasticSearch to return partial results
+TIMEOUT_GRACE = 0.5
+
+
 # ### QUERY DSL HANDLING
 class Query():
 
+    # The per-type query trees share the fragments which are the same for all types (e.g. matchers, sorting,
+    # highlighting), so these must never be modified in place once applied - only replaced.
+
+    # Compiled filter and lookup parameters, shared by all queries
+    _compiled_complex = OrderedDict()
+    _compiled_complex_lock = threading.Lock()
+
     def __init__(self, search_indexes):
         self.types = list(search_indexes.keys())
         self.filtered_type_names = set(self.types)
-        self.indexes = list(search_indexes.values())
+        # Each type maps to an index name, or to a (client, index name) tuple
+        # for types which are stored in a different cluster than the default one
+        self.clients = [
+            index[0] if isinstance(index, tuple) else None
+            for index in search_indexes.values()
+        ]
+        self.indexes = [
+            index[1] if isinstance(index, tuple) else index
+            for index in search_indexes.values()
+        ]
         self.q = dict((t, {}) for t in self.types)
-        self.json = demjson.JSON()
-        self.json.set_hook('decode_float', float)
+        self.timeout = None
+        self.preference = dict()
+        self.routing = dict()
+        # The term matcher of each type, and its parameters (for search templates)
+        self.term_matchers = dict()
+        self.term_params = None
+        self._json = None
+
 
+    @property
+    def json(self):
+        # Only needed for decoding lenient JSON parameters, so it's created (and demjson imported) on first use
+        if self._json is None:
+            import demjson3 as demjson
+
+            self._json = demjson.JSON()
+            self._json.set_hook('decode_float', float)
+        return self._json
+
+    @json.setter
+    def json(self, value):
+        self._json = value
 
     def __str__(self):
         return self.json.encode(self.q)
 
-    def run(self, es_client: Elasticsearch, debug):
+    def run(self, es_client: Elasticsearch, debug, request_cache=False, hedger=None, templates=None):
+        self.log_query(debug)
+        entries = self.msearch_template_entries(templates, request_cache) if templates is not None else None
+        if entries is not None:
+            return self.msearch(es_client, entries, self.timeout, hedger, template=True)
+        return self.msearch(es_client, self.msearch_entries(request_cache), self.timeout, hedger)
+
+    @staticmethod
+    def run_batch(es_client: Elasticsearch, queries, debug, request_cache=False, hedger=None, templates=None):
+        # Send the sub-searches of all queries in a single msearch and split the responses back per query
+        for query in queries:
+            query.log_query(debug)
+        timeout = max((query.timeout for query in queries if query.timeout is not None), default=None)
+        # Search templates are only used if all sub-searches can use them
+        entries = None
+        if templates is not None:
+            entries = [query.msearch_template_entries(templates, request_cache) for query in queries]
+            entries = None if None in entries else [entry for query_entries in entries for entry in query_entries]
+        if entries is not None:
+            responses = Query.msearch(es_client, entries, timeout, hedger, template=True)['responses']
+        else:
+            entries = [entry for query in queries for entry in query.msearch_entries(request_cache)]
+            responses = Query.msearch(es_client, entries, timeout, hedger)['responses']
+        ret = []
+        for query in queries:
+            count = len(query.searched_types())
+            ret.append(dict(responses=responses[:count]))
+            responses = responses[count:]
+        return ret
+
+    @staticmethod
+    def msearch(es_client: Elasticsearch, entries, timeout=None, hedger=None, template=False):
+        """
+        Runs sub-searches using msearch, grouped by the client each should be sent to
+
+        :param es_client: The default client
+        :param entries: A list of (client, sub-search) tuples (with client being None for the default client)
+        :param timeout: Time (in seconds) after which requests are cancelled, and their sub-searches are reported
+        as timed out
+        :param hedger: A Hedger, to send duplicate requests for slow ones
+        :param template: Whether the sub-searches are search template requests
+        :return: The msearch response, with the responses of all sub-searches in the order of `entries`
+        """
+        groups = dict()
+        for i, (client, body) in enumerate(entries):
+            groups.setdefault(id(client), (client or es_client, []))[1].append((i, body))
+        if len(groups) == 1:
+            client, bodies = next(iter(groups.values()))
+            return Query._msearch_group(client, bodies, timeout, hedger, template)
+
+        # Run each client's group concurrently, and reassemble the responses in order
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            results = [
+                (bodies, executor.submit(Query._msearch_group, client, bodies, timeout, hedger, template))
+                for client, bodies in groups.values()
+            ]
+            responses = [None] * len(entries)
+            took = 0
+            for bodies, future in results:
+                result = future.result()
+                took = max(took, result.get('took', 0))
+                for (i, _), response in zip(bodies, result['responses']):
+                    responses[i] = response
+        return dict(took=took, responses=responses)
+
+    @staticmethod
+    def _msearch_group(client, bodies, timeout, hedger=None, template=False):
+        body = ''.join(body for _, body in bodies)
+        if timeout is not None:
+            client = client.options(request_timeout=timeout + TIMEOUT_GRACE)
+        if template:
+            def send(body):
+                return client.msearch_template(search_templates=body)
+        else:
+            def send(body):
+                return client.msearch(searches=body)
+        try:
+            if hedger is not None:
+                return hedger.run(send, body)
+            return send(body)
+        except ConnectionTimeout:
+            if timeout is None:
+                raise
+            logger.warning('msearch timed out after %s seconds', timeout)
+            return dict(
+                took=int(timeout * 1000),
+                responses=[dict(timed_out=True, error='request timed out') for _ in bodies]
+            )
+
+    def log_query(self, debug):
         if debug:
             logger.debug('QUERY (for %s):\n%s', self.types[0],
                          json.dumps(self.q[self.types[0]], indent=2, ensure_ascii=False))
@@ -28,15 +170,64 @@ class Query():
                 logger.debug('QUERY (for %s):\n%s', self.types[-1],
                             json.dumps(self.q[self.types[-1]], indent=2, ensure_ascii=False))
 
-        body = ''.join(
-            '{}\n{}\n'.format(
-                json.dumps(dict(index=index)),
-                json.dumps(self.q[t])
-            )
-            for t, index in zip(self.types, self.indexes)
-            if t in self.filtered_type_names
-        )
-        return es_client.msearch(searches=body)
+    def msearch_body(self, request_cache=False, profile=False):
+        return ''.join(body for _, body in self.msearch_entries(request_cache, profile))
+
+    def msearch_entries(self, request_cache=False, profile=False):
+        entries = []
+        # Types usually end up with identical bodies, which are only encoded once
+        # (comparing them is cheap, as they mostly share the same fragments)
+        encoded = []
+        for t, index, client in zip(self.types, self.indexes, self.clients):
+            if t not in self.filtered_type_names:
+                continue
+            body = dict(self.q[t], profile=True) if profile else self.q[t]
+            for other, other_encoded in encoded:
+                if other == body:
+                    body_encoded = other_encoded
+                    break
+            else:
+                body_encoded = json.dumps(body, sort_keys=True)
+                encoded.append((body, body_encoded))
+            entries.append((client, '{}\n{}\n'.format(
+                json.dumps(self.header(t, index, request_cache), sort_keys=True),
+                body_encoded
+            )))
+        return entries
+
+    def msearch_template_entries(self, templates, request_cache=False):
+        """
+        :param templates: The SearchTemplates
+        :return: Similar to `msearch_entries`, but with search template requests (or None, if some sub-search
+        can't use its search template)
+        """
+        entries = []
+        for t, index, client in zip(self.types, self.indexes, self.clients):
+            if t not in self.filtered_type_names:
+                continue
+            params = templates.params(self, t)
+            if params is None:
+                return None
+            entries.append((client, '{}\n{}\n'.format(
+                json.dumps(self.header(t, index, request_cache), sort_keys=True),
+                json.dumps(params, sort_keys=True)
+            )))
+        return entries
+
+    def header(self, t, index, request_cache=False):
+        header = dict(index=index)
+        if t in self.preference:
+            header['preference'] = self.preference[t]
+        if t in self.routing:
+            header['routing'] = self.routing[t]
+        # Only size=0 requests are cached by ElasticSearch's shard request cache
+        if request_cache and self.q[t].get('size') == 0:
+            header['request_cache'] = True
+        return header
+
+    def searched_types(self):
+        # The types actually sent in the msearch, in the order of its responses
+        return [t for t in self.types if t in self.filtered_type_names]
 
     def query_bool(self, t):
         return self.q[t].setdefault('query', {})\
@@ -63,131 +254,223 @@ class Query():
 
     def apply_term(self, term, text_fields,
                    multi_match_type='most_fields', multi_match_operator='and'):
+        # Tuples
+        parts = term.split()
+        parts = tuple(sorted(set([term] + parts + [' '.join(z) for z in zip(parts[:-1], parts[1:])])))
+
+        # Types with the same text fields share the same matcher
+        shared = dict()
         for type_name in self.types:
-            search_fields = text_fields[type_name]
-            search_fields = dict(
-                (k, [x[1] for x in search_fields if x[0] == k])
-                for k in ('exact', 'inexact', 'natural')
+            search_fields = tuple(text_fields[type_name])
+            if search_fields not in shared:
+                shared[search_fields] = self._term_matcher(term, parts, search_fields,
+                                                           multi_match_type, multi_match_operator)
+            if shared[search_fields] is not None:
+                self.must(type_name).append(shared[search_fields])
+                self.term_matchers[type_name] = shared[search_fields]
+        self.term_params = dict(term=term, parts=parts,
+                                multi_match_type=multi_match_type, multi_match_operator=multi_match_operator)
+
+        return self
+
+    def _term_matcher(self, term, parts, search_fields, multi_match_type, multi_match_operator):
+        search_fields = dict(
+            (k, [x[1] for x in search_fields if x[0] == k])
+            for k in ('exact', 'inexact', 'natural')
+        )
+        matchers = []
+
+        # Multimatch for inexact fields
+        matchers.append(dict(
+            multi_match=dict(
+                query=term,
+                fields=[f for f in search_fields['inexact'] + search_fields['natural']],
+                type=multi_match_type,
+                operator=multi_match_operator,
+                tie_breaker=0.3
             )
-            matchers = []
+        ))
 
-            # Multimatch for inexact fields
-            matchers.append(dict(
-                multi_match=dict(
-                    query=term,
-                    fields=[f for f in search_fields['inexact'] + search_fields['natural']],
-                    type=multi_match_type,
-                    operator=multi_match_operator,
-                    tie_breaker=0.3
+        # Tuples
+        for field in search_fields['exact']:
+            fparts = field.split('^')
+            if len(fparts) == 1:
+                matchers.append(dict(
+                    terms={
+                        field: parts
+                    }
+                ))
+            else:
+                matchers.append(dict(
+                    terms={
+                        fparts[0]: parts,
+                        'boost': float(fparts[1])
+                    }
+                ))
+
+        # Apply boosters
+        if len(matchers) > 0:
+            return dict(
+                bool=dict(
+                    should=matchers,
+                    minimum_should_match=1
                 )
-            ))
+            )
+        return None
 
-            # Tuples
-            parts = term.split()
-            parts = [term] + parts + [' '.join(z) for z in zip(parts[:-1], parts[1:])]
-            for field in search_fields['exact']:
-                fparts = field.split('^')
-                if len(fparts) == 1:
+    def apply_suggest(self, term, text_fields):
+        # Prefix matching on the text fields, without counting the total number of matches
+        shared = dict()
+        for type_name in self.types:
+            search_fields = tuple(text_fields[type_name])
+            if search_fields not in shared:
+                matchers = []
+                inexact = [x[1] for x in search_fields if x[0] in ('inexact', 'natural')]
+                if len(inexact) > 0:
+                    # bool_prefix treats the last term as a prefix, and works with search_as_you_type fields
                     matchers.append(dict(
-                        terms={
-                            field: tuple(set(parts))
-                        }
+                        multi_match=dict(
+                            query=term,
+                            fields=inexact,
+                            type='bool_prefix',
+                            operator='and'
+                        )
                     ))
-                else:
+                for field in [x[1] for x in search_fields if x[0] == 'exact']:
+                    fparts = field.split('^')
+                    prefix = dict(value=term)
+                    if len(fparts) > 1:
+                        prefix['boost'] = float(fparts[1])
                     matchers.append(dict(
-                        terms={
-                            fparts[0]: tuple(set(parts)),
-                            'boost': float(fparts[1])
+                        prefix={
+                            fparts[0]: prefix
                         }
                     ))
-
-            # Apply boosters
-            if len(matchers) > 0:
-                self.must(type_name).append(dict(
+                shared[search_fields] = dict(
                     bool=dict(
                         should=matchers,
                         minimum_should_match=1
                     )
-                ))
+                )
+            self.must(type_name).append(shared[search_fields])
+            self.q[type_name]['track_total_hits'] = False
+        return self
 
+    def apply_ids(self, ids):
+        # Only match the given documents of each type (without affecting the scoring)
+        for type_name in self.types:
+            self.filter(type_name).setdefault('must', []).append(dict(
+                ids=dict(
+                    values=ids.get(type_name, [])
+                )
+            ))
+        return self
+
+    def apply_source(self, source_fields):
+        # Only fetch the given fields of each type's documents (or no source, for types without fields)
+        for type_name in self.types:
+            self.q[type_name]['_source'] = list(source_fields.get(type_name) or []) or False
         return self
 
     def apply_term_context(self, terms, text_fields):
         multi_match_type = 'most_fields'
         multi_match_operator = 'or'
+        shared = dict()
         for type_name in self.types:
-            search_fields = text_fields[type_name]
-            search_fields = [
-                x[1] for x in search_fields if x[0] == 'inexact'
-            ]
-            matcher = dict(
-                multi_match=dict(
-                    query=terms,
-                    fields=search_fields,
-                    type=multi_match_type,
-                    operator=multi_match_operator,
-                    tie_breaker=0.3
-                )
+            search_fields = tuple(
+                x[1] for x in text_fields[type_name] if x[0] == 'inexact'
             )
-            self.filter(type_name).setdefault('must', []).append(matcher)
+            if search_fields not in shared:
+                shared[search_fields] = dict(
+                    multi_match=dict(
+                        query=terms,
+                        fields=list(search_fields),
+                        type=multi_match_type,
+                        operator=multi_match_operator,
+                        tie_breaker=0.3
+                    )
+                )
+            self.filter(type_name).setdefault('must', []).append(shared[search_fields])
 
         return self
 
     def apply_scoring(self):
+        field_value_factor = dict(
+            field='score',
+            modifier='sqrt',
+            missing=1
+        )
         for type_name in self.types:
             fs = self.q[type_name].setdefault('query', {}).setdefault('function_score', {})
             fs.update(dict(
                 boost_mode='multiply',
-                field_value_factor=dict(
-                    field='score',
-                    modifier='sqrt',
-                    missing=1
-                )
+                field_value_factor=field_value_factor
             ))
         return self
 
     def apply_sorting(self, sort_fields, score_threshold):
-        # Apply the scoring threshold so as not to get irrelevant results
+        if isinstance(sort_fields, str):
+            if sort_fields[0] == '-':
+                trimmed_fields = sort_fields[1:]
+                sort = {trimmed_fields: {'order': 'desc'}}
+            else:
+                sort = {sort_fields: {'order': 'asc'}}
+        else:
+            sort = sort_fields
+
+        if isinstance(sort, dict):
+            sort = [sort]
+
         for type_name in self.types:
             q = self.q[type_name]
+            # Apply the scoring threshold so as not to get irrelevant results
             q.setdefault('min_score', score_threshold)
-            if isinstance(sort_fields, str):
-                if sort_fields[0] == '-':
-                    trimmed_fields = sort_fields[1:]
-                    sort = {trimmed_fields: {'order': 'desc'}}
-                else:
-                    sort = {sort_fields: {'order': 'asc'}}
-            else:
-                sort = sort_fields
-
-            if isinstance(sort, dict):
-                sort = [sort]
             # Then sort by the sort fields, for example - {'__last_modified_at': {'order': 'desc'}}
             q.setdefault('sort', sort)
 
         return self
 
+    def apply_collapse(self, field, inner_hits=None):
+        # Collapse results to the best document of each `field` value, counting the distinct values for the totals
+        if field:
+            collapse = dict(field=field)
+            if inner_hits:
+                collapse['inner_hits'] = dict(name='collapsed', size=int(inner_hits))
+            total = dict(
+                cardinality=dict(
+                    field=field,
+                    precision_threshold=40000
+                )
+            )
+            for type_name in self.types:
+                self.q[type_name]['collapse'] = collapse
+                self.q[type_name].setdefault('aggs', {})['collapse:total'] = total
+        return self
+
     def apply_pagination(self, page_size, offset):
+        page_size = int(page_size)
+        offset = int(offset)
         for type_name in self.types:
             self.q[type_name].update({
-                'size': int(page_size),
-                'from': int(offset)
+                'size': page_size,
+                'from': offset
             })
         return self
 
     def apply_highlighting(self, term, highlight, snippets):
-        for type_name in self.types:
-            self.q[type_name]['highlight'] = dict(
-                fields=dict(
-                    (f, dict() if f in snippets else dict(number_of_fragments=0)) for f in highlight + snippets
-                ),
-                highlight_query=dict(
-                    multi_match=dict(
-                        query=term,
-                        fields=highlight + snippets,
-                    )
+        highlighting = dict(
+            fields=dict(
+                (f, dict() if f in snippets else dict(number_of_fragments=0)) for f in highlight + snippets
+            ),
+            highlight_query=dict(
+                multi_match=dict(
+                    query=term,
+                    fields=highlight + snippets,
                 )
             )
+        )
+        for type_name in self.types:
+            self.q[type_name]['highlight'] = highlighting
         return self
 
     def parse_filter_op(self, k, v):
@@ -282,6 +565,35 @@ class Query():
         if not param:
             return None
 
+        compiled = self._compile_complex_cached(param)
+        if compiled is None:
+            return None
+
+        should_clauses = dict()
+        for type_names, clause in compiled:
+            for type_name in type_names or self.types:
+                should_clauses.setdefault(type_name, []).append(clause)
+        return should_clauses
+
+    def _compile_complex_cached(self, param):
+        # Compiled clauses are shared between queries, so they must not be modified
+        if isinstance(param, str):
+            key = (type(self), param)
+        else:
+            key = (type(self), json.dumps(param, sort_keys=True))
+        cache = Query._compiled_complex
+        with Query._compiled_complex_lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+        compiled = self._compile_complex(param)
+        with Query._compiled_complex_lock:
+            cache[key] = compiled
+            while len(cache) > COMPILED_COMPLEX_CACHE_SIZE:
+                cache.popitem(last=False)
+        return compiled
+
+    def _compile_complex(self, param):
         if isinstance(param, str):
             if param.startswith('[') and param.endswith(']'):
                 pass
@@ -293,25 +605,25 @@ class Query():
             param = [param]
 
         if isinstance(param, list):
-            should_clauses = dict()
+            compiled = []
             for i in param:
                 bool_clause = {}
-                type_names = self.types
+                # None stands for all of the query's types
+                type_names = None
                 for k, v in i.items():
                     if k == '_type':
                         if not isinstance(v, list):
-                            type_names = [v]
+                            type_names = (v,)
                         else:
-                            type_names = v
+                            type_names = tuple(v)
                     else:
                         clause, positive = self.parse_filter_op(k, v)
                         if positive:
                             bool_clause.setdefault('must', []).append(clause)
                         else:
                             bool_clause.setdefault('must_not', []).append(clause)
-                for type_name in type_names:
-                    should_clauses.setdefault(type_name, []).append(dict(bool=bool_clause))
-            return should_clauses
+                compiled.append((type_names, dict(bool=bool_clause)))
+            return tuple(compiled)
 
         return None
 
@@ -345,25 +657,58 @@ class Query():
         self.filtered_type_names = set(should_clauses.keys())
         return self
 
-    def apply_time_range(self, from_date, to_date):
+    def round_date(self, date, rounding):
+        if rounding is None:
+            return date
+        length, unit = DATE_ROUNDING[rounding]
+        if date.startswith('now'):
+            return date if '/' in date else '{}/{}'.format(date, unit)
+        # Truncate to the rounding unit and let ElasticSearch round the bound
+        # (down for gte, up for lte) so that nearby dates produce identical queries
+        return '{}||/{}'.format(date.split('||')[0][:length], unit)
+
+    def apply_time_range(self, from_date, to_date, rounding=None):
         if None not in (from_date, to_date):
-            for type_name in self.types:
-                self.must(type_name).extend([
-                    dict(
-                        range=dict(
-                            __date_range_from=dict(
-                                lte=to_date
-                            )
+            from_date = self.round_date(from_date, rounding)
+            to_date = self.round_date(to_date, rounding)
+            time_range = [
+                dict(
+                    range=dict(
+                        __date_range_from=dict(
+                            lte=to_date
                         )
-                    ),
-                    dict(
-                        range=dict(
-                            __date_range_to=dict(
-                                gte=from_date
-                            )
+                    )
+                ),
+                dict(
+                    range=dict(
+                        __date_range_to=dict(
+                            gte=from_date
                         )
-                    ),
-                ])
+                    )
+                ),
+            ]
+            for type_name in self.types:
+                self.must(type_name).extend(time_range)
+        return self
+
+    def apply_timeout(self, timeout):
+        if timeout is not None:
+            self.timeout = timeout
+            for type_name in self.types:
+                self.q[type_name]['timeout'] = '{}ms'.format(int(timeout * 1000))
+        return self
+
+    def apply_preference(self, preference, routing=None):
+        """
+        :param preference: The shard preference of all types, or a dict mapping types to their preferences
+        :param routing: A dict mapping types to their routing values
+        """
+        for type_name in self.types:
+            value = preference.get(type_name) if isinstance(preference, dict) else preference
+            if value is not None:
+                self.preference[type_name] = value
+            if routing and routing.get(type_name) is not None:
+                self.routing[type_name] = routing[type_name]
         return self
 
     def apply_exact_total(self):
@@ -372,16 +717,29 @@ class Query():
         return self
 
     def apply_month_aggregates(self):
+        timeline = dict(
+            terms=dict(
+                field='__date_range_months',
+                size=2500,
+                order=dict(_term='asc')
+            )
+        )
         for type_name in self.types:
-            self.q[type_name].setdefault('aggs', {}).update(dict(
-                timeline=dict(
-                    terms=dict(
-                        field='__date_range_months',
-                        size=2500,
-                        order=dict(_term='asc')
-                    )
+            self.q[type_name].setdefault('aggs', {})['timeline'] = timeline
+        return self
+
+    def apply_terms_aggregates(self, fields, size=100):
+        facets = dict(
+            ('facet:' + field, dict(
+                terms=dict(
+                    field=field,
+                    size=size
                 )
             ))
+            for field in fields
+        )
+        for type_name in self.types:
+            self.q[type_name].setdefault('aggs', {}).update(facets)
         return self
 
     def apply_extra(self, extras):
@@ -0,0 +1,80 @@
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+from .logger import logger
+
+
+slow_logger = logger.getChild('slow_queries')
+
+
+class SlowQueryLog():
+    """
+    Logs queries whose total latency or ElasticSearch `took` time pass a threshold.
+
+    Records are logged as JSON to the `apies.slow_queries` logger, and contain the endpoint, the request parameters,
+    the total latency, the `took` time of each type and the full msearch body.
+    A sample of the slow queries can be re-run in the background with profiling enabled, and the profile output is
+    stored (along with the record) in `profile_dir`.
+    """
+
+    def __init__(self, threshold=None, took_threshold=None, profile_rate=0.0, profile_dir=None):
+        """
+        :param threshold: Total latency (in seconds) above which a query is considered slow
+        :param took_threshold: ElasticSearch `took` time (in milliseconds) above which a query is considered slow
+        :param profile_rate: Fraction of slow queries to re-run with `profile: true`
+        :param profile_dir: Directory to store profile outputs in (if not set, profiles are logged)
+        """
+        self.threshold = threshold
+        self.took_threshold = took_threshold
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+
+    def check(self, es_client, endpoint, params, queries, results, elapsed, request_cache=False):
+        timings = [
+            dict(type=_type, took=response.get('took'))
+            for query, result in zip(queries, results)
+            for _type, response in zip(query.searched_types(), result['responses'])
+        ]
+        took = max([t['took'] for t in timings if t['took'] is not None], default=0)
+        slow = self.threshold is not None and elapsed >= self.threshold
+        slow_took = self.took_threshold is not None and took >= self.took_threshold
+        if not (slow or slow_took):
+            return
+
+        record = dict(
+            id=uuid.uuid4().hex,
+            endpoint=endpoint,
+            params=params,
+            elapsed=round(elapsed * 1000),
+            took=took,
+            timings=timings,
+            body=''.join(query.msearch_body(request_cache) for query in queries),
+        )
+        slow_logger.warning('SLOW QUERY %s', json.dumps(record, default=str, ensure_ascii=False))
+
+        if self.profile_rate and random.random() < self.profile_rate:
+            entries = [entry for query in queries for entry in query.msearch_entries(request_cache, profile=True)]
+            threading.Thread(target=self._profile, args=(es_client, type(queries[0]), entries, record),
+                             daemon=True).start()
+
+    def _profile(self, es_client, query_cls, entries, record):
+        try:
+            responses = query_cls.msearch(es_client, entries)['responses']
+            profiled = json.dumps(
+                dict(record, profiles=[response.get('profile') for response in responses]),
+                default=str, ensure_ascii=False
+            )
+            if self.profile_dir:
+                filename = os.path.join(self.profile_dir,
+                                        '{}-{}.json'.format(time.strftime('%Y%m%d%H%M%S'), record['id']))
+                with open(filename, 'w') as out:
+                    out.write(profiled)
+                slow_logger.info('SLOW QUERY PROFILE stored in %s', filename)
+            else:
+                slow_logger.info('SLOW QUERY PROFILE %s', profiled)
+        except Exception:
+            slow_logger.exception('Failed to profile slow query %s', record['id'])
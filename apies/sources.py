@@ -1,12 +1,12 @@
-from copy import copy
+import json
+import os
 
-from datapackage import Package, Resource
-from tableschema import Field
+from copy import copy, deepcopy
 
 from .logger import logger
 
 
-def _process_field(field: Field, rules, field_select, ret, prefix):
+def _process_field(field, rules, field_select, ret, prefix):
     schema_type = field['type']
     if schema_type == 'array':
         field = copy(field)
@@ -32,18 +32,80 @@ def _process_schema(schema, rules, field_select, ret=[], prefix=''):
     return ret
 
 
+def _local_descriptor(src):
+    # Descriptors of local datapackages with inline schemas are read directly, as datapackage is slow to import
+    if isinstance(src, dict):
+        descriptor = src
+    elif isinstance(src, str) and src.endswith('.json') and '://' not in src and os.path.isfile(src):
+        with open(src) as f:
+            descriptor = json.load(f)
+    else:
+        return None
+    resources = descriptor.get('resources') or [{}]
+    if 'name' not in resources[0] or not isinstance(resources[0].get('schema'), dict):
+        return None
+    schema = deepcopy(resources[0]['schema'])
+    # Same defaults as tableschema's
+    for field in schema.get('fields', []):
+        field.setdefault('type', 'string')
+        field.setdefault('format', 'default')
+    schema.setdefault('missingValues', [''])
+    return (resources[0]['name'], schema)
+
+
+def load_sources(sources):
+    """
+    :param sources: A list of datapackages (descriptors, paths or Package objects)
+    :return list: The name and schema (descriptor) of the first resource of each datapackage
+    """
+    ret = []
+    for src in sources:
+        if isinstance(src, tuple):
+            ret.append(src)
+            continue
+        descriptor = _local_descriptor(src)
+        if descriptor is None:
+            from datapackage import Package
+
+            if not isinstance(src, Package):
+                src = Package(src)
+            resource = src.resources[0]
+            descriptor = (resource.name, resource.schema.descriptor)
+        ret.append(descriptor)
+    return ret
+
+
+def extract_schemas(sources):
+    return dict(load_sources(sources))
+
+
+def _title_fields(schema, ret, prefix=''):
+    for field in schema['fields']:
+        if field.get('es:exclude', False):
+            continue
+        if field['type'] == 'object':
+            _title_fields(field.get('es:schema') or dict(fields=[]), ret, prefix + field['name'] + '.')
+        elif field.get('es:title'):
+            ret.append(prefix + field['name'])
+    return ret
+
+
+def extract_title_fields(sources):
+    sources = load_sources(sources)
+
+    ret = {}
+    for type_name, schema in sources:
+        ret[type_name] = _title_fields(schema, [])
+    return ret
+
+
 def extract_text_fields(sources, text_field_rules, text_field_select, debug=False):
 
-    sources = [src if isinstance(src, Package) else Package(src)
-               for src in sources]
+    sources = load_sources(sources)
 
     ret = {}
-    source: Package
-    for source in sources:
-        resource: Resource = source.resources[0]
-        type_name = resource.name
+    for type_name, schema in sources:
         type_text_field_select = text_field_select.get(type_name) if text_field_select else None
-        schema = resource.schema.descriptor
         text_fields = _process_schema(schema, text_field_rules, type_text_field_select, ret=[])
         ret[type_name] = text_fields
         if debug:
@@ -0,0 +1,116 @@
+import hashlib
+import json
+
+from .logger import logger
+
+
+# Placeholders for the template parameters in the term matcher
+TERM = '\x00term'
+PARTS = '\x00parts'
+MATCH_TYPE = '\x00match_type'
+MATCH_OPERATOR = '\x00match_operator'
+
+# The term matcher is followed by the other parts of the query, which are sent as parameters
+# (the function score and body parameters are lists of keys and values)
+SEARCH_TEMPLATE = ''.join([
+    '{"query": {"function_score": {"query": {"bool": {"must": [',
+    '%s',
+    '{{#has_bool}}, {"bool": {{#toJson}}bool{{/toJson}} }{{/has_bool}}',
+    ']}}',
+    '{{#function_score}}, "{{key}}": {{#toJson}}value{{/toJson}}{{/function_score}}',
+    '}}',
+    '{{#body}}, "{{key}}": {{#toJson}}value{{/toJson}}{{/body}}',
+    '}',
+])
+
+# The keys of the query's bool clause which can be sent as a nested bool clause, without affecting the scoring
+NESTED_BOOL_KEYS = {'must', 'should', 'filter', 'minimum_should_match'}
+
+
+class SearchTemplates():
+    """
+    Stored search templates of each type's term searches.
+
+    The templates contain the term matcher of each type (with its many boosted text fields), so that term searches
+    only need to send the term and the other parts of the query (filters, pagination, sorting etc.) as parameters.
+
+    :param query_cls: The Query class, used to build the term matchers
+    :param text_fields: A dict mapping types to their text fields
+    :param prefix: Prefix of the templates' ids
+    """
+
+    def __init__(self, query_cls, text_fields, prefix='apies-'):
+        self.sources = dict()
+        self.ids = dict()
+        query = query_cls({})
+        for type_name, search_fields in text_fields.items():
+            matcher = query._term_matcher(TERM, PARTS, tuple(search_fields), MATCH_TYPE, MATCH_OPERATOR)
+            if matcher is None:
+                continue
+            matcher = json.dumps(matcher, sort_keys=True)
+            for placeholder in (TERM, PARTS, MATCH_TYPE, MATCH_OPERATOR):
+                matcher = matcher.replace(json.dumps(placeholder), '{{#toJson}}%s{{/toJson}}' % placeholder[1:])
+            source = SEARCH_TEMPLATE % matcher
+            self.sources[type_name] = source
+            # Changing the text fields changes the id, so different versions can be used side by side
+            self.ids[type_name] = '{}{}-{}'.format(
+                prefix, type_name, hashlib.blake2b(source.encode('utf8'), digest_size=6).hexdigest()
+            )
+        self.registered = set()
+
+    def register(self, es_client, search_indexes):
+        """
+        Stores the templates of all types in their clusters.
+
+        Types whose template could not be stored are searched without it.
+        """
+        for type_name, index in search_indexes.items():
+            if type_name not in self.ids:
+                continue
+            client = index[0] if isinstance(index, tuple) else es_client
+            try:
+                client.put_script(id=self.ids[type_name], script=dict(lang='mustache', source=self.sources[type_name]))
+                self.registered.add(type_name)
+            except Exception:
+                logger.exception('Failed to store the search template of %s', type_name)
+
+    def params(self, query, type_name):
+        """
+        :return: The template search of the type's query (or None, if the query can't be expressed by the template)
+        """
+        matcher = query.term_matchers.get(type_name)
+        if type_name not in self.registered or matcher is None:
+            return None
+        body = dict(query.q[type_name])
+        if set(body.get('query', {})) != {'function_score'}:
+            return None
+        function_score = dict(body.pop('query')['function_score'])
+        if set(function_score.get('query', {})) != {'bool'}:
+            return None
+        bool_clause = dict(function_score.pop('query')['bool'])
+        must = [clause for clause in bool_clause.get('must', []) if clause is not matcher]
+        if len(must) == len(bool_clause.get('must', [])) or not set(bool_clause) <= NESTED_BOOL_KEYS:
+            return None
+        if must:
+            bool_clause['must'] = must
+        else:
+            bool_clause.pop('must', None)
+        # A nested bool clause with only a minimum_should_match would match all documents
+        if bool_clause and not set(bool_clause) & {'must', 'should', 'filter'}:
+            return None
+
+        term = query.term_params
+        params = dict(
+            term=term['term'],
+            parts=term['parts'],
+            match_type=term['multi_match_type'],
+            match_operator=term['multi_match_operator'],
+            has_bool=len(bool_clause) > 0,
+            bool=bool_clause,
+            function_score=self._items(function_score),
+            body=self._items(body),
+        )
+        return dict(id=self.ids[type_name], params=params)
+
+    def _items(self, obj):
+        return [dict(key=key, value=value) for key, value in sorted(obj.items())]
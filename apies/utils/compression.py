@@ -0,0 +1,107 @@
+import importlib
+import importlib.util
+import zlib
+
+
+class GzipCompressor():
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        # Flushed so that every chunk can be sent as soon as it's ready
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor():
+
+    def __init__(self):
+        brotli = importlib.import_module('brotli')
+        self.compressor = brotli.Compressor(quality=5)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class ZstdCompressor():
+
+    def __init__(self):
+        self.zstandard = importlib.import_module('zstandard')
+        self.compressor = self.zstandard.ZstdCompressor().compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(self.zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush(self.zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+# The compression libraries are only imported when first used
+COMPRESSORS = dict(
+    gzip=GzipCompressor,
+    br=BrotliCompressor if importlib.util.find_spec('brotli') is not None else None,
+    zstd=ZstdCompressor if importlib.util.find_spec('zstandard') is not None else None,
+)
+
+
+def available_encodings(encodings=None):
+    """
+    :param encodings: A list of content encodings, in order of preference (all encodings, if not set)
+    :return list: The encodings which are supported (i.e. their compression libraries are installed)
+    """
+    if encodings is None:
+        encodings = ['br', 'zstd', 'gzip']
+    return [encoding for encoding in encodings if COMPRESSORS.get(encoding) is not None]
+
+
+def compress(data, encoding):
+    compressor = COMPRESSORS[encoding]()
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_stream(chunks, encoding, min_size):
+    """
+    Compresses a stream of chunks incrementally.
+
+    Chunks are buffered until at least `min_size` bytes are available, streams shorter than that are not compressed.
+
+    :param chunks: An iterable of (bytes or str) chunks
+    :param encoding: The content encoding to use
+    :param min_size: The minimal size (in bytes) of a stream to compress
+    :return (tuple): Whether the stream is compressed, and an iterator over the (possibly) compressed chunks
+    """
+    chunks = iter(chunks)
+    buffered = []
+    size = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf8')
+        buffered.append(chunk)
+        size += len(chunk)
+        if size >= min_size:
+            break
+    else:
+        return False, iter(buffered)
+
+    def compressed():
+        try:
+            compressor = COMPRESSORS[encoding]()
+            yield compressor.compress(b''.join(buffered))
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf8')
+                if chunk:
+                    yield compressor.compress(chunk)
+            yield compressor.finish()
+        finally:
+            # Release the underlying stream, even if the response was not fully sent
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    return True, compressed()
@@ -1,6 +1,7 @@
 import csv
-import xlwt
-import xlsxwriter
+import datetime
+import itertools
+import json
 
 from io import BytesIO, StringIO
 
@@ -22,21 +23,35 @@ def get_csv(es_result, column_mapping):
     for the output file
     """
 
+    return ''.join(iter_csv(es_result, column_mapping))
+
+
+def iter_csv(es_result, column_mapping, batch_size=1000):
+    """
+    Creates the contents of a csv file in chunks, so it can be streamed while the results are being fetched
+
+    :param es_result (dict): The result of the ElasticSearch search (`search_results` may be any iterable)
+    :param column_mapping (dict): A dict mapping the column names in the original data, to the desired column headers
+    for the output file
+    :param batch_size (int): Number of rows in each chunk
+
+    :return (generator): The csv file contents, in chunks of rows
+    """
+
     # Create a string stream and writer object, passing the stream
     file_stream = StringIO()
     writer = csv.writer(file_stream)
 
     # Get ordered lists of column headers (the 'titles' of the columns) and the column names (how the fields are called
     # in ElasticSearch
-    document_source = es_result['search_results'][0]['source']
+    document_source, documents = _peek_source(es_result['search_results'])
     column_headers, column_names = _get_column_headers_and_names(document_source, column_mapping)
 
     # Write the header row
     writer.writerow(column_headers)
 
     # Loop over the documents, for each document loop over the fields and retrieve the field from the document
-    documents = es_result['search_results']
-    for document in documents:
+    for document_index, document in enumerate(documents):
         document_row = []
         for field_name in column_names:
             field_value = _get_field_value(field_name, document['source'])
@@ -44,8 +59,139 @@ def get_csv(es_result, column_mapping):
         # Write the document field
         writer.writerow(document_row)
 
-    # Return the stream string
-    return file_stream.getvalue()
+        # Flush a chunk of rows
+        if (document_index + 1) % batch_size == 0:
+            yield file_stream.getvalue()
+            file_stream.seek(0)
+            file_stream.truncate()
+
+    # Flush the remaining rows
+    yield file_stream.getvalue()
+
+
+def iter_ndjson(es_result, batch_size=1000):
+    """
+    Creates the contents of a newline delimited JSON file in chunks, one document source per line (nested fields
+    are kept intact)
+
+    :param es_result (dict): The result of the ElasticSearch search (`search_results` may be any iterable)
+    :param batch_size (int): Number of lines in each chunk
+
+    :return (generator): The file contents, in chunks of lines
+    """
+
+    lines = []
+    for document in es_result['search_results']:
+        lines.append(json.dumps(document['source'], ensure_ascii=False))
+        lines.append('\n')
+
+        # Flush a chunk of lines
+        if len(lines) >= 2 * batch_size:
+            yield ''.join(lines)
+            lines = []
+
+    # Flush the remaining lines
+    yield ''.join(lines)
+
+
+def get_parquet(es_result, column_mapping, schemas, row_group_size=10000):
+    """
+    Creates a stream with a Parquet file, written in row groups from batches of results
+
+    Column types are taken from the schema of the documents' type, nested fields are written as JSON strings.
+    Requires pyarrow (`pip install apies[parquet]`).
+
+    :param es_result (dict): The result of the ElasticSearch search (`search_results` may be any iterable)
+    :param column_mapping (dict): A dict mapping the column names in the original data, to the desired column headers
+    for the output file
+    :param schemas (dict): A dict mapping each document type to its (datapackage) schema
+    :param row_group_size (int): Number of rows in each row group
+
+    :return (BytesIO): A stream with the Parquet file
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Create a bytes stream
+    file_stream = BytesIO()
+
+    # Get ordered lists of the column headers ('column titles') and the column names (how the fields are actually called
+    # in the ElasticSearch results)
+    documents = iter(es_result['search_results'])
+    first = next(documents, None)
+    document_source = first['source'] if first is not None else None
+    column_headers, column_names = _get_column_headers_and_names(document_source, column_mapping)
+
+    # Get the type of each column from the schema
+    fields = {}
+    if first is not None:
+        fields = dict((field['name'], field) for field in schemas.get(first['type'], {}).get('fields', []))
+    column_types = [fields.get(column_name, {}).get('type', 'string') for column_name in column_names]
+    parquet_types = _parquet_types()
+    schema = pa.schema([
+        (column_header, parquet_types.get(column_type, parquet_types['string'])[0]())
+        for column_header, column_type in zip(column_headers, column_types)
+    ])
+
+    # Write the documents in row groups
+    writer = pq.ParquetWriter(file_stream, schema)
+    documents = itertools.chain([first], documents) if first is not None else documents
+    while True:
+        batch = list(itertools.islice(documents, row_group_size))
+        if len(batch) == 0:
+            break
+        columns = [
+            [_convert_value(_get_field_value(column_name, document['source']), column_type, parquet_types)
+             for document in batch]
+            for column_name, column_type in zip(column_names, column_types)
+        ]
+        writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+    writer.close()
+
+    # Rewind the buffer
+    file_stream.seek(0)
+
+    return file_stream
+
+
+def _parquet_types():
+    """
+    Maps (datapackage) schema types to their Parquet types and converters from JSON values
+    """
+
+    import pyarrow as pa
+
+    return {
+        'string': (pa.string, None),
+        'integer': (pa.int64, int),
+        'number': (pa.float64, float),
+        'boolean': (pa.bool_, lambda v: v.lower() in ('true', 'yes', '1')),
+        'date': (pa.date32, lambda v: datetime.date.fromisoformat(v[:10])),
+        'datetime': (lambda: pa.timestamp('us'), lambda v: datetime.datetime.fromisoformat(v.replace('Z', '+00:00'))),
+    }
+
+
+def _convert_value(value, schema_type, parquet_types):
+    """
+    Converts a value from a document source to the Python type of its (datapackage) schema type
+
+    :return: The converted value, or None if it's empty or can't be converted
+    """
+
+    if value is None or value == '':
+        return None
+    if schema_type not in parquet_types or schema_type == 'string':
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, ensure_ascii=False)
+        return str(value)
+    convert = parquet_types[schema_type][1]
+    if isinstance(value, str) or schema_type in ('integer', 'number'):
+        try:
+            return convert(value)
+        except (ValueError, TypeError):
+            return None
+    return value
 
 
 def get_xls(es_result, column_mapping):
@@ -56,9 +202,13 @@ def get_xls(es_result, column_mapping):
     :param column_mapping (dict): A dict mapping the column names in the original data, to the desired column headers
     for the output file
 
+    Requires xlwt (`pip install apies[download]`).
+
     :return (BytesIO): A stream with the Excel file
     """
 
+    import xlwt
+
     # Create a bytes stream
     file_stream = BytesIO()
 
@@ -68,7 +218,7 @@ def get_xls(es_result, column_mapping):
 
     # Get ordered lists of the column headers ('column titles') and the column names (how the fields are actually called
     # in the ElasticSearch results)
-    document_source = es_result['search_results'][0]['source']
+    document_source, documents = _peek_source(es_result['search_results'])
     column_headers, column_names = _get_column_headers_and_names(document_source, column_mapping)
 
     # Write the first row of column names
@@ -76,7 +226,6 @@ def get_xls(es_result, column_mapping):
         worksheet.write(0, index, column_name)
 
     # Write the rows
-    documents = es_result['search_results']
     # Loop over the documents
     for document_index, document in enumerate(documents):
         # Loop over the columns
@@ -99,9 +248,13 @@ def get_xlsx(es_result, column_mapping):
     :param column_mapping (dict): A dict mapping the column names in the original data, to the desired column headers
     for the output file
 
+    Requires xlsxwriter (`pip install apies[download]`).
+
     :return (IO.BytesIO): A stream with the Excel file
     """
 
+    import xlsxwriter
+
     # Create a file stream
     output = BytesIO()
 
@@ -111,7 +264,7 @@ def get_xlsx(es_result, column_mapping):
 
     # Get ordered lists of the column headers ('column titles') and the column names (how the fields are actually called
     # in the ElasticSearch results)
-    document_source = es_result['search_results'][0]['source']
+    document_source, documents = _peek_source(es_result['search_results'])
     column_headers, column_names = _get_column_headers_and_names(document_source, column_mapping)
 
     # Write the first row of column names
@@ -119,7 +272,6 @@ def get_xlsx(es_result, column_mapping):
         worksheet.write(0, index, column_header)
 
     # Write the rows
-    documents = es_result['search_results']
     for document_index, document in enumerate(documents):
         # Loop over the columns
         for column_index, column_name in enumerate(column_names):
@@ -135,6 +287,22 @@ def get_xlsx(es_result, column_mapping):
     return output
 
 
+def _peek_source(documents):
+    """
+    Gets the source of the first document, without consuming it from the documents
+
+    :param documents: A list or an iterator of search results
+    :return (tuple): The source of the first document (or None, if there are no documents), and an iterator over
+    all documents
+    """
+
+    documents = iter(documents)
+    first = next(documents, None)
+    if first is None:
+        return None, documents
+    return first['source'], itertools.chain([first], documents)
+
+
 def _get_column_headers_and_names(document_source, column_mapping):
     """
     Creates ordered lists of column headers (the 'titles of the columns), and column names (the name of the fields in
@@ -166,7 +334,7 @@ def _get_column_headers_and_names(document_source, column_mapping):
 
     # If no column_mapping is sent, simply set the order, and the column_names are the same as the column_headers
     else:
-        column_headers = [field for field in document_source]
+        column_headers = [field for field in document_source or []]
         column_names = column_headers
 
     return column_headers, column_names
@@ -0,0 +1,52 @@
+import json
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .logger import logger
+
+
+def load_warmup_log(filename):
+    """
+    :param filename: A JSONL file, with the request parameters of a query in each line
+    :return list: The queries
+    """
+    with open(filename) as log:
+        return [json.loads(line) for line in log if line.strip()]
+
+
+class Warmup():
+    """
+    Replays queries in the background, with bounded concurrency
+
+    :param run: A function running a query, returning whether it succeeded
+    :param concurrency: Maximum number of queries to run concurrently
+    """
+
+    def __init__(self, run, concurrency=2):
+        self.run = run
+        self.concurrency = concurrency
+
+    def start(self, queries):
+        """
+        :return: The background thread running the queries
+        """
+        thread = threading.Thread(target=self._run_all, args=(list(queries),), name='apies-warmup', daemon=True)
+        thread.start()
+        return thread
+
+    def _run_all(self, queries):
+        start = time.perf_counter()
+        logger.info('Warming up with %d queries', len(queries))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            succeeded = sum(executor.map(self._run_one, queries))
+        logger.info('Warmup done: %d queries (%d failed) in %.1f seconds',
+                    len(queries), len(queries) - succeeded, time.perf_counter() - start)
+
+    def _run_one(self, query):
+        try:
+            return bool(self.run(query))
+        except Exception:
+            logger.exception('Failed to warm up with %r', query)
+            return False
@@ -0,0 +1,67 @@
+"""
+Measures the cold-start cost of apies: the time it takes to import it and to create a blueprint,
+the memory (RSS) of the process afterwards, and which of the heavy optional dependencies were loaded.
+
+Each measurement runs in a fresh interpreter.
+
+Example:
+
+    $ python benchmark_import.py --runs 10
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+
+# Dependencies which should only be loaded when actually used
+HEAVY_MODULES = ['datapackage', 'tableschema', 'demjson3', 'xlwt', 'xlsxwriter', 'pyarrow', 'brotli', 'zstandard']
+
+MEASURE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import apies
+imported = time.perf_counter()
+if {create}:
+    from flask import Flask
+    app = Flask('benchmark')
+    schema = dict(fields=[dict(name='title', type='string', **{{'es:title': True}}), dict(name='body', type='string')])
+    blueprint = apies.apies_blueprint(app, [dict(name='docs', resources=[dict(name='docs', path='docs.csv', schema=schema)])],
+                                      None, dict(docs='docs-index'), 'docs-index')
+    app.register_blueprint(blueprint, url_prefix='/api/')
+created = time.perf_counter()
+with open('/proc/self/statm') as statm:
+    rss = int(statm.read().split()[1]) * resource.getpagesize()
+print(json.dumps(dict(
+    import_time=imported - start,
+    create_time=created - imported,
+    rss=rss,
+    loaded=[name for name in {heavy} if name in sys.modules],
+)))
+'''
+
+
+def measure(create):
+    output = subprocess.check_output([
+        sys.executable, '-c', MEASURE.format(create=create, heavy=HEAVY_MODULES)
+    ])
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import time and memory of apies')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs to take the median of')
+    parser.add_argument('--no-blueprint', action='store_true', help='Only import apies, without creating a blueprint')
+    args = parser.parse_args()
+
+    results = [measure(not args.no_blueprint) for _ in range(args.runs)]
+    print('import apies:      {:8.1f} ms'.format(statistics.median(r['import_time'] for r in results) * 1000))
+    if not args.no_blueprint:
+        print('create blueprint:  {:8.1f} ms'.format(statistics.median(r['create_time'] for r in results) * 1000))
+    print('RSS:               {:8.1f} MB'.format(statistics.median(r['rss'] for r in results) / 1024 / 1024))
+    print('heavy modules loaded: {}'.format(', '.join(results[-1]['loaded']) or 'none'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Measures the time it takes to serve search result pages, with and without `fast_json`.
+
+Each search is answered with a pre-encoded ElasticSearch response, decoded by the client serializer of each mode
+(the standard library's json, or orjson), so the measured time includes decoding the response and encoding
+the result page - but not the network or the search itself.
+
+Example:
+
+    $ python benchmark_json.py --size 100 --runs 50
+"""
+import argparse
+import json
+import statistics
+import time
+
+from elasticsearch.serializer import JsonSerializer, OrjsonSerializer
+from flask import Flask
+
+from apies import apies_blueprint
+
+
+# (number of fields, size of each field in bytes) of the document sources
+SHAPES = [(40, 20), (200, 20), (5, 2048)]
+
+
+class EncodedClient():
+    """
+    An ElasticSearch client returning the same encoded response for all searches
+    """
+
+    def __init__(self, serializer, fields, field_size, hits):
+        self.serializer = serializer
+        response = dict(
+            took=3,
+            timed_out=False,
+            hits=dict(
+                total=dict(value=1000, relation='eq'),
+                hits=[
+                    dict(_index='docs', _id=str(i), _score=1.0 / (i + 1), _source=dict(
+                        ('field{}'.format(field), '{:0{}d}'.format(i, field_size)) for field in range(fields)
+                    ))
+                    for i in range(hits)
+                ]
+            )
+        )
+        self.data = json.dumps(dict(responses=[response])).encode('utf8')
+
+    def options(self, **kwargs):
+        return self
+
+    def msearch(self, searches=None, **kwargs):
+        return self.serializer.loads(self.data)
+
+
+def measure(fast_json, fields, field_size, size, runs):
+    serializer = OrjsonSerializer() if fast_json else JsonSerializer()
+    schema = dict(fields=[dict(name='field{}'.format(field), type='string') for field in range(fields)])
+    app = Flask('benchmark')
+    blueprint = apies_blueprint(app, [dict(name='docs', resources=[dict(name='docs', path='docs.csv', schema=schema)])],
+                                EncodedClient(serializer, fields, field_size, size),
+                                dict(docs='docs-index'), 'docs-index', fast_json=fast_json)
+    app.register_blueprint(blueprint, url_prefix='/api/')
+    client = app.test_client()
+    path = '/api/search/docs?size={}'.format(size)
+    result = client.get(path).get_json()
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        client.get(path).get_data()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the time it takes to serve search result pages')
+    parser.add_argument('--size', type=int, default=100, help='Number of results in each page')
+    parser.add_argument('--runs', type=int, default=50, help='Number of requests to take the median of')
+    args = parser.parse_args()
+
+    print('{:>8} {:>12} {:>12} {:>12} {:>8}'.format('fields', 'field bytes', 'json ms', 'fast_json ms', 'speedup'))
+    for fields, field_size in SHAPES:
+        slow = measure(False, fields, field_size, args.size, args.runs)
+        fast = measure(True, fields, field_size, args.size, args.runs)
+        print('{:>8} {:>12} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+            fields, field_size, slow * 1000, fast * 1000, slow / fast
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""
+Replays a log of API requests through the blueprint against a stub ElasticSearch cluster,
+and reports the latency percentiles, throughput and worker memory of each endpoint.
+
+The request log is a JSONL file, with a line per request - either a path (e.g. `"/api/search/jobs?q=engineer"`)
+or an object with a `path` and optionally a `method` and a JSON `body` (e.g. for `/search/batch`).
+
+Examples:
+
+    $ python replay.py requests.jsonl --concurrency 16 --repeat 5
+    $ python replay.py requests.jsonl --latency 20 --hits 50 --source-size 4096 --config '{"cache_ttl": 60}'
+    $ python replay.py requests.jsonl --stub http --processes 4
+    $ python replay.py requests.jsonl --latency 5 --slow-rate 0.02 --slow-latency 500 --config '{"hedge_percentile": 95}'
+"""
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+
+import elasticsearch
+
+from datapackage import Package
+from flask import Flask
+
+from apies import apies_blueprint
+
+
+# A stand-in for the sample datapackage, used when it's not available
+SCHEMA = dict(fields=[
+    {'name': 'doc_id', 'type': 'string', 'es:keyword': True},
+    {'name': 'Business Title', 'type': 'string', 'es:title': True},
+    {'name': 'Agency', 'type': 'string', 'es:keyword': True},
+    {'name': 'Job Description', 'type': 'string'},
+    {'name': 'Posting Date', 'type': 'date'},
+    {'name': 'score', 'type': 'integer'},
+])
+
+
+class StubCluster():
+    """
+    Generates ElasticSearch responses, without actually searching anything
+
+    :param latency: Time (in milliseconds) each request takes
+    :param hits: Number of hits to return for each search (up to its `size`)
+    :param source_size: Approximate size (in bytes) of each document source
+    :param slow_rate: Fraction of requests which are slow (e.g. served by a slow node)
+    :param slow_latency: Time (in milliseconds) slow requests take
+    """
+
+    def __init__(self, latency=0, hits=10, source_size=1024, slow_rate=0.0, slow_latency=0):
+        self.latency = latency / 1000
+        self.hits = hits
+        self.padding = 'x' * max(0, source_size - 100)
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency / 1000
+
+    def _wait(self):
+        if self.slow_rate and random.random() < self.slow_rate:
+            time.sleep(self.slow_latency)
+        elif self.latency:
+            time.sleep(self.latency)
+
+    def _hit(self, index, i):
+        return dict(
+            _index=index,
+            _id='{}/{}'.format(index, i),
+            _score=1.0 / (i + 1),
+            _source={
+                'doc_id': 'job/{}'.format(i),
+                'Business Title': 'Title {}'.format(i),
+                'Agency': 'AGENCY {}'.format(i % 10),
+                'Job Description': self.padding,
+                'score': 1,
+            }
+        )
+
+    def _response(self, index, body):
+        size = body.get('size', 10)
+        response = dict(
+            took=int(self.latency * 1000),
+            timed_out=False,
+            hits=dict(
+                total=dict(value=1000, relation='eq'),
+                hits=[self._hit(index, i) for i in range(min(size, self.hits))]
+            )
+        )
+        if 'aggs' in body:
+            response['aggregations'] = dict(
+                (name, dict(value=100) if 'cardinality' in agg else dict(buckets=[
+                    dict(key='value {}'.format(i), doc_count=100 - i) for i in range(10)
+                ]))
+                for name, agg in body['aggs'].items()
+            )
+        return response
+
+    def msearch(self, searches):
+        self._wait()
+        lines = [json.loads(line) for line in searches.strip().split('\n')]
+        return dict(responses=[
+            self._response(header.get('index'), body)
+            for header, body in zip(lines[::2], lines[1::2])
+        ])
+
+    def search(self, index, body):
+        self._wait()
+        response = self._response(index, body)
+        response['_scroll_id'] = 'last' if len(response['hits']['hits']) < body.get('size', 10) else 'more'
+        return response
+
+    def scroll(self, scroll_id):
+        self._wait()
+        return dict(_scroll_id='last', hits=dict(hits=[]))
+
+    def get(self, index, id):
+        self._wait()
+        return dict(_index=index, _id=id, found=True, _source=self._hit(index, 0)['_source'])
+
+
+class StubClient():
+    """
+    An in-process ElasticSearch client, backed by a StubCluster
+    """
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def options(self, **kwargs):
+        return self
+
+    def msearch(self, searches=None, **kwargs):
+        if not isinstance(searches, str):
+            searches = '\n'.join(json.dumps(line) for line in searches)
+        return self.cluster.msearch(searches)
+
+    def search(self, index=None, body=None, **kwargs):
+        return self.cluster.search(index, body or {})
+
+    def scroll(self, scroll_id=None, **kwargs):
+        return self.cluster.scroll(scroll_id)
+
+    def clear_scroll(self, **kwargs):
+        return dict(succeeded=True)
+
+    def get(self, index=None, id=None, **kwargs):
+        return self.cluster.get(index, id)
+
+
+def serve_stub_cluster(cluster):
+    """
+    Serves a StubCluster over HTTP (so that requests go through the actual ElasticSearch client)
+
+    :return: The URL of the server
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        # Keep connections alive, like an actual cluster
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _respond(self, response):
+            data = json.dumps(response).encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('X-Elastic-Product', 'Elasticsearch')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length).decode('utf8') if length else ''
+
+        def do_GET(self):
+            match = re.match(r'^/([^/]+)/_doc/(.+)$', self.path.split('?')[0])
+            if match:
+                return self._respond(self.cluster.get(match.group(1), match.group(2)))
+            self._respond(dict(version=dict(number='8.0.0'), tagline='You Know, for Search'))
+
+        def do_POST(self):
+            path = self.path.split('?')[0]
+            body = self._body()
+            if path.endswith('/_msearch'):
+                return self._respond(self.cluster.msearch(body))
+            if path == '/_search/scroll':
+                return self._respond(self.cluster.scroll(json.loads(body).get('scroll_id')))
+            if path.endswith('/_search'):
+                return self._respond(self.cluster.search(path.split('/')[1], json.loads(body or '{}')))
+            self._respond(dict())
+
+        def do_DELETE(self):
+            self._body()
+            self._respond(dict(succeeded=True))
+
+    Handler.cluster = cluster
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def make_app(es_client, datapackage=None, config=None):
+    if datapackage is not None:
+        package = Package(datapackage)
+    else:
+        package = Package(dict(name='jobs', resources=[dict(name='jobs', path='jobs.csv', schema=SCHEMA)]))
+    app = Flask('replay')
+    blueprint = apies_blueprint(
+        app,
+        [package],
+        es_client,
+        dict(jobs='jobs-job'),
+        'jobs-document',
+        **(config or {})
+    )
+    app.register_blueprint(blueprint, url_prefix='/api/')
+    return app
+
+
+def load_requests(filename):
+    requests = []
+    with open(filename) as log:
+        for line in log:
+            line = line.strip()
+            if not line:
+                continue
+            request = json.loads(line)
+            if isinstance(request, str):
+                request = dict(path=request)
+            request.setdefault('method', 'GET')
+            requests.append(request)
+    return requests
+
+
+def current_rss():
+    # Resident set size (in bytes) of this process
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def replay(args, requests):
+    """
+    Replays the requests in a single worker process
+
+    :return: The time (in seconds) replaying took, and a dict mapping endpoints to their latencies (in seconds),
+    number of errors and maximal RSS (in bytes)
+    """
+    cluster = StubCluster(latency=args.latency, hits=args.hits, source_size=args.source_size,
+                          slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+    if args.stub == 'http':
+        es_client = elasticsearch.Elasticsearch(serve_stub_cluster(cluster))
+    else:
+        es_client = StubClient(cluster)
+    app = make_app(es_client, args.datapackage, json.loads(args.config) if args.config else None)
+    adapter = app.url_map.bind('localhost')
+    local = threading.local()
+    lock = threading.Lock()
+    stats = dict()
+
+    def run(request):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        endpoint = adapter.match(request['path'].split('?')[0], method=request['method'])[0].split('.')[-1]
+        start = time.perf_counter()
+        response = local.client.open(request['path'], method=request['method'], json=request.get('body'))
+        # Consume streamed responses
+        response.get_data()
+        elapsed = time.perf_counter() - start
+        error = response.status_code != 200 or (response.is_json and 'error' in (response.get_json() or {}))
+        rss = current_rss()
+        with lock:
+            endpoint_stats = stats.setdefault(endpoint, dict(latencies=[], errors=0, rss=0))
+            endpoint_stats['latencies'].append(elapsed)
+            endpoint_stats['errors'] += int(bool(error))
+            endpoint_stats['rss'] = max(endpoint_stats['rss'], rss)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for _ in executor.map(run, requests * args.repeat):
+            pass
+    return time.perf_counter() - start, stats
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of sorted values
+    return values[max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))]
+
+
+def report(stats, elapsed):
+    rows = []
+    for endpoint, endpoint_stats in sorted(stats.items()) + [('total', dict(
+        latencies=[latency for s in stats.values() for latency in s['latencies']],
+        errors=sum(s['errors'] for s in stats.values()),
+        rss=max([s['rss'] for s in stats.values()], default=0),
+    ))]:
+        latencies = sorted(endpoint_stats['latencies'])
+        if not latencies:
+            continue
+        rows.append(dict(
+            endpoint=endpoint,
+            requests=len(latencies),
+            errors=endpoint_stats['errors'],
+            throughput=round(len(latencies) / elapsed, 1),
+            p50=round(percentile(latencies, 50) * 1000, 2),
+            p95=round(percentile(latencies, 95) * 1000, 2),
+            p99=round(percentile(latencies, 99) * 1000, 2),
+            rss=round(endpoint_stats['rss'] / 1024 / 1024, 1),
+        ))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a request log against a stub ElasticSearch cluster')
+    parser.add_argument('log', help='JSONL file of requests')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent requests in each worker process')
+    parser.add_argument('--processes', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times to replay the log')
+    parser.add_argument('--stub', choices=['client', 'http'], default='client',
+                        help='Use an in-process stub client, or a stub HTTP server with the actual client')
+    parser.add_argument('--latency', type=float, default=0, help='Latency (in ms) of each ElasticSearch request')
+    parser.add_argument('--slow-rate', type=float, default=0, help='Fraction of ElasticSearch requests which are slow')
+    parser.add_argument('--slow-latency', type=float, default=0, help='Latency (in ms) of slow requests')
+    parser.add_argument('--hits', type=int, default=10, help='Number of hits in each search response')
+    parser.add_argument('--source-size', type=int, default=1024, help='Size (in bytes) of each document source')
+    parser.add_argument('--datapackage', help='Datapackage of the searched type (default: a stub jobs schema)')
+    parser.add_argument('--config', help='JSON object of additional blueprint options (e.g. {"cache_ttl": 60})')
+    parser.add_argument('--json', action='store_true', help='Output the report as JSON')
+    args = parser.parse_args()
+
+    requests = load_requests(args.log)
+    if args.processes > 1:
+        # Each worker process replays its share of the log
+        with Pool(args.processes) as pool:
+            results = pool.starmap(replay, [(args, requests[i::args.processes]) for i in range(args.processes)])
+    else:
+        results = [replay(args, requests)]
+    # Worker processes replay concurrently, so throughput is measured over the longest one
+    elapsed = max(result[0] for result in results)
+
+    stats = dict()
+    for _, result in results:
+        for endpoint, endpoint_stats in result.items():
+            merged = stats.setdefault(endpoint, dict(latencies=[], errors=0, rss=0))
+            merged['latencies'].extend(endpoint_stats['latencies'])
+            merged['errors'] += endpoint_stats['errors']
+            merged['rss'] = max(merged['rss'], endpoint_stats['rss'])
+
+    rows = report(stats, elapsed)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print('{:<28} {:>9} {:>7} {:>10} {:>9} {:>9} {:>9} {:>9}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'RSS MB'))
+    for row in rows:
+        print('{endpoint:<28} {requests:>9} {errors:>7} {throughput:>10} {p50:>9} {p95:>9} {p99:>9} {rss:>9}'
+              .format(**row))
+
+
+if __name__ == '__main__':
+    main()
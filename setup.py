@@ -21,18 +21,30 @@ def read(*paths):
 PACKAGE = 'apies'
 NAME = PACKAGE.replace('_', '-')
 INSTALL_REQUIRES = [
-    'Flask',
+    'Flask>=2.0',
     'requests',
     'elasticsearch>=7.0.0,<9.0.0',
     'datapackage',
     'flask_jsonpify',
     'demjson3',
-    'xlwt',
-    'xlsxwriter'
 ]
 LINT_REQUIRES = [
     'pylama',
 ]
+DOWNLOAD_REQUIRES = [
+    'xlwt',
+    'xlsxwriter',
+]
+PARQUET_REQUIRES = [
+    'pyarrow',
+]
+COMPRESSION_REQUIRES = [
+    'brotli',
+    'zstandard',
+]
+FAST_JSON_REQUIRES = [
+    'orjson',
+]
 TESTS_REQUIRE = [
     'tox',
     'dataflows-elasticsearch>=0.1.0',
@@ -51,6 +63,10 @@ setup(
     tests_require=TESTS_REQUIRE,
     extras_require={
         'develop': LINT_REQUIRES + TESTS_REQUIRE,
+        'download': DOWNLOAD_REQUIRES,
+        'parquet': PARQUET_REQUIRES,
+        'compression': COMPRESSION_REQUIRES,
+        'fast_json': FAST_JSON_REQUIRES,
     },
     zip_safe=False,
     long_description=README,
@@ -0,0 +1,24 @@
+import pytest
+
+from flask import Flask
+
+from apies import apies_blueprint
+
+
+SCHEMA = dict(fields=[
+    {'name': 'title', 'type': 'string', 'es:title': True},
+    {'name': 'kind', 'type': 'string', 'es:keyword': True},
+    {'name': 'n', 'type': 'integer'},
+])
+
+
+@pytest.fixture
+def make_client():
+    def make(es_client, types=('jobs', 'docs'), **kwargs):
+        app = Flask('test')
+        sources = [dict(name=name, resources=[dict(name=name, path=name + '.csv', schema=SCHEMA)]) for name in types]
+        blueprint = apies_blueprint(app, sources, es_client, dict((name, name + '-index') for name in types),
+                                    types[0] + '-index', **kwargs)
+        app.register_blueprint(blueprint, url_prefix='/api/')
+        return app.test_client()
+    return make
@@ -0,0 +1,90 @@
+import json
+
+
+def _ids_filter(body):
+    # The ids of the second phase of two-phase searches, if any
+    found = []
+
+    def visit(obj):
+        if isinstance(obj, dict):
+            if 'ids' in obj:
+                found.append(obj['ids']['values'])
+            for value in obj.values():
+                visit(value)
+        elif isinstance(obj, list):
+            for value in obj:
+                visit(value)
+
+    visit(body)
+    return found[0] if found else None
+
+
+class StubES():
+    """
+    An ElasticSearch client returning canned hits
+
+    :param docs: A dict mapping indexes to their hits, in the order they're returned (each with an `_id`,
+    a `_source` and its `sort` values)
+    :param missing: Ids of documents which are never returned when fetched by their ids
+    """
+
+    def __init__(self, docs, missing=()):
+        self.docs = docs
+        self.missing = set(missing)
+        self.searches = []
+        self.scrolls = dict()
+        self.cleared = []
+
+    def options(self, **kwargs):
+        return self
+
+    def _hits(self, index, body):
+        hits = self.docs.get(index, [])
+        ids = _ids_filter(body)
+        if ids is not None:
+            hits = [hit for hit in hits if hit['_id'] in ids and hit['_id'] not in self.missing]
+        start = body.get('from', 0)
+        ret = []
+        for hit in hits[start:start + body.get('size', 10)]:
+            hit = dict(hit, _index=index, _score=hit['sort'][0])
+            if body.get('_source') is False:
+                hit.pop('_source')
+            ret.append(hit)
+        return ret
+
+    def msearch(self, searches=None, **kwargs):
+        lines = [json.loads(line) for line in searches.strip().split('\n')]
+        responses = []
+        for header, body in zip(lines[::2], lines[1::2]):
+            self.searches.append((header['index'], body))
+            responses.append(dict(
+                took=1,
+                timed_out=False,
+                hits=dict(
+                    total=dict(value=len(self.docs.get(header['index'], [])), relation='eq'),
+                    hits=self._hits(header['index'], body)
+                )
+            ))
+        return dict(responses=responses)
+
+    def search(self, index=None, body=None, scroll=None, **kwargs):
+        # Each slice holds every `max`-th hit, so the hits of each slice keep their order
+        self.searches.append((index, body))
+        hits = self.docs.get(index, [])
+        if 'slice' in body:
+            hits = hits[body['slice']['id']::body['slice']['max']]
+        scroll_id = '{}/{}'.format(index, len(self.scrolls))
+        self.scrolls[scroll_id] = ([dict(hit, _index=index, _score=None) for hit in hits], body.get('size', 10))
+        return self.scroll(scroll_id)
+
+    def scroll(self, scroll_id=None, **kwargs):
+        hits, size = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (hits[size:], size)
+        return dict(_scroll_id=scroll_id, hits=dict(hits=hits[:size]))
+
+    def clear_scroll(self, scroll_id=None, **kwargs):
+        self.cleared.append(scroll_id)
+
+
+def hit(_id, *sort, **source):
+    return dict(_id=_id, sort=list(sort), _source=dict(source, title=_id))
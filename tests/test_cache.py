@@ -0,0 +1,95 @@
+import multiprocessing
+
+from apies.cache import MmapCacheBackend
+
+
+SLOT_SIZE = 4096
+
+
+def backend(path, ways=2):
+    # A single set, so that all keys compete for the same slots
+    return MmapCacheBackend(path, size=SLOT_SIZE * ways, slot_size=SLOT_SIZE, ways=ways)
+
+
+def _set(path, key, stored_at, value):
+    backend(path).set(key, stored_at, value)
+
+
+def _get(path, key, out):
+    out.put(backend(path).get(key))
+
+
+def _hammer(path, worker, rounds, errors):
+    cache = backend(path, ways=4)
+    for i in range(rounds):
+        key = 'key-{}'.format((worker + i) % 6)
+        cache.set(key, float(i), dict(key=key, payload='x' * (i % 500)))
+        entry = cache.get(key)
+        # Entries may be evicted by other processes, but must never be torn or mixed up
+        if entry is not None and entry[1]['key'] != key:
+            errors.put((key, entry))
+
+
+def run(target, *args):
+    process = multiprocessing.Process(target=target, args=args)
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+
+def test_shared_between_processes(tmp_path):
+    path = str(tmp_path / 'cache')
+    run(_set, path, 'a', 1.0, dict(value=1))
+
+    assert backend(path).get('a') == (1.0, dict(value=1))
+
+    backend(path).set('b', 2.0, dict(value=2))
+    out = multiprocessing.Queue()
+    run(_get, path, 'b', out)
+    assert out.get(timeout=5) == (2.0, dict(value=2))
+
+
+def test_evicts_least_recently_used(tmp_path):
+    path = str(tmp_path / 'cache')
+    run(_set, path, 'a', 1.0, dict(value=1))
+    run(_set, path, 'b', 2.0, dict(value=2))
+    # Reading 'a' makes 'b' the least recently used entry
+    assert backend(path).get('a') is not None
+    run(_set, path, 'c', 3.0, dict(value=3))
+
+    cache = backend(path)
+    assert cache.get('a') == (1.0, dict(value=1))
+    assert cache.get('b') is None
+    assert cache.get('c') == (3.0, dict(value=3))
+
+
+def test_replaces_existing_entry(tmp_path):
+    path = str(tmp_path / 'cache')
+    run(_set, path, 'a', 1.0, dict(value=1))
+    run(_set, path, 'a', 2.0, dict(value=2))
+    run(_set, path, 'b', 3.0, dict(value=3))
+
+    cache = backend(path)
+    assert cache.get('a') == (2.0, dict(value=2))
+    assert cache.get('b') == (3.0, dict(value=3))
+
+
+def test_skips_large_entries(tmp_path):
+    cache = backend(str(tmp_path / 'cache'))
+    cache.set('a', 1.0, dict(value='x' * SLOT_SIZE))
+    assert cache.get('a') is None
+
+
+def test_concurrent_processes(tmp_path):
+    path = str(tmp_path / 'cache')
+    errors = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_hammer, args=(path, worker, 300, errors))
+        for worker in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+    assert errors.empty()
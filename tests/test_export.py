@@ -0,0 +1,88 @@
+import json
+
+from apies.export import SortKey, sort_directions
+
+from .stubs import StubES, hit
+
+
+def test_sort_key_directions():
+    assert SortKey([1], ['asc']) < SortKey([2], ['asc'])
+    assert not SortKey([2], ['asc']) < SortKey([1], ['asc'])
+    assert SortKey([2], ['desc']) < SortKey([1], ['desc'])
+    assert not SortKey([1], ['desc']) < SortKey([2], ['desc'])
+
+
+def test_sort_key_ties():
+    # Later sort values only break ties
+    assert SortKey([1, 'b'], ['desc', 'asc']) < SortKey([1, 'c'], ['desc', 'asc'])
+    assert SortKey([2, 'z'], ['desc', 'asc']) < SortKey([1, 'a'], ['desc', 'asc'])
+    assert not SortKey([1, 'a'], ['asc', 'asc']) < SortKey([1, 'a'], ['asc', 'asc'])
+    assert SortKey([1, 'a'], ['asc', 'asc']) == SortKey([1, 'a'], ['asc', 'asc'])
+
+
+def test_sort_key_missing_values_last():
+    for direction in ('asc', 'desc'):
+        assert SortKey([1], [direction]) < SortKey([None], [direction])
+        assert not SortKey([None], [direction]) < SortKey([1], [direction])
+
+
+def test_sort_directions():
+    assert sort_directions(['_score', 'n']) == ['desc', 'asc']
+    assert sort_directions([{'n': {'order': 'desc'}}, {'_score': {}}, {'m': 'asc'}]) == ['desc', 'desc', 'asc']
+
+
+def export(client, types, query):
+    response = client.get('/api/download/{}?export=1&file_format=ndjson&{}'.format(types, query))
+    assert response.status_code == 200
+    return [json.loads(line)['title'] for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_ordered_export_across_slices(make_client):
+    es = StubES({
+        'jobs-index': [hit('job-{}'.format(n), n) for n in range(0, 20, 2)],
+        'docs-index': [hit('doc-{}'.format(n), n) for n in range(1, 20, 2)],
+    })
+    client = make_client(es, export_batch_size=2)
+
+    titles = export(client, 'jobs,docs', 'order=n&slices=3')
+
+    expected = ['{}-{}'.format('job' if n % 2 == 0 else 'doc', n) for n in range(20)]
+    assert titles == expected
+    assert all(body['slice']['max'] == 3 for _, body in es.searches)
+
+
+def test_ordered_export_descending(make_client):
+    es = StubES({
+        'jobs-index': [hit('job-{}'.format(n), n) for n in (9, 7, 4, 3)],
+        'docs-index': [hit('doc-{}'.format(n), n) for n in (8, 6, 5, None)],
+    })
+    client = make_client(es)
+
+    titles = export(client, 'jobs,docs', 'order=-n&slices=2')
+
+    assert titles == ['job-9', 'doc-8', 'job-7', 'doc-6', 'doc-5', 'job-4', 'job-3', 'doc-None']
+
+
+def test_ordered_export_fits_slices_to_workers(make_client):
+    types = ('a', 'b', 'c')
+    es = StubES(dict(('{}-index'.format(name), [hit(name, 1)]) for name in types))
+    client = make_client(es, types=types, export_slices=4, export_workers=8)
+
+    assert export(client, 'a,b,c', 'order=n') == ['a', 'b', 'c']
+    # 8 workers are split between 3 types
+    assert sorted(body['slice']['max'] for _, body in es.searches) == [2] * 6
+
+
+def test_ordered_export_of_too_many_types(make_client):
+    client = make_client(StubES({}), export_workers=1)
+
+    response = client.get('/api/download/jobs,docs?export=1&order=n&file_format=ndjson')
+
+    assert response.status_code == 400
+
+
+def test_export_size(make_client):
+    es = StubES({'jobs-index': [hit('job-{}'.format(n), n) for n in range(10)]})
+    client = make_client(es, export_batch_size=2)
+
+    assert export(client, 'jobs', 'order=n&slices=1&size=3') == ['job-0', 'job-1', 'job-2']
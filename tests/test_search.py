@@ -0,0 +1,118 @@
+from .stubs import StubES, hit
+
+
+def searched_timeouts(es):
+    return set(body.get('timeout') for _, body in es.searches)
+
+
+def test_timeout(make_client):
+    es = StubES({'jobs-index': [hit('job-1', 1.0)]})
+    client = make_client(es)
+
+    result = client.get('/api/search/jobs?q=x&timeout=1.5').get_json()
+
+    assert len(result['search_results']) == 1
+    assert searched_timeouts(es) == {'1500ms'}
+
+
+def test_timeout_capped(make_client):
+    es = StubES({'jobs-index': [hit('job-1', 1.0)]})
+    client = make_client(es, search_timeout=2)
+
+    client.get('/api/search/jobs?q=x&timeout=100000')
+    client.get('/api/search/jobs?q=x')
+
+    assert searched_timeouts(es) == {'2000ms'}
+
+
+def test_invalid_timeout(make_client):
+    es = StubES({'jobs-index': [hit('job-1', 1.0)]})
+    client = make_client(es, search_timeout=2)
+
+    for timeout in ('0', '-1', 'inf', 'nan', 'soon'):
+        assert 'error' in client.get('/api/search/jobs?q=x&timeout=' + timeout).get_json()
+    assert es.searches == []
+
+
+def two_phase_stub(**kwargs):
+    return StubES({
+        'jobs-index': [hit('job-{}'.format(n), n) for n in (9, 7, 5, 3, 1)],
+        'docs-index': [hit('doc-{}'.format(n), n) for n in (8, 6, 4, 2)],
+    }, **kwargs)
+
+
+def titles(result):
+    return [result['source']['title'] for result in result['search_results']]
+
+
+def test_two_phase_descending(make_client):
+    es = two_phase_stub()
+    client = make_client(es)
+
+    result = client.get('/api/search/jobs,docs?q=x&size=4&two_phase=1').get_json()
+
+    assert titles(result) == ['job-9', 'doc-8', 'job-7', 'doc-6']
+    assert result['search_counts'] == dict(
+        _current=dict(total_overall=9),
+        jobs=dict(total_overall=5),
+        docs=dict(total_overall=4),
+    )
+    # The first phase fetches only the sort values, and the second only the documents of the page
+    first, second = es.searches[:2], es.searches[2:]
+    assert [(body['size'], body['from'], body['_source']) for _, body in first] == [(4, 0, False)] * 2
+    assert all('ids' in str(body['query']) for _, body in second)
+
+
+def test_two_phase_ascending(make_client):
+    es = StubES({
+        'jobs-index': [hit('job-{}'.format(n), n) for n in (1, 4, 5)],
+        'docs-index': [hit('doc-{}'.format(n), n) for n in (2, 3, None)],
+    })
+    client = make_client(es)
+
+    result = client.get('/api/search/jobs,docs?q=x&size=10&order=n&two_phase=1').get_json()
+
+    assert titles(result) == ['job-1', 'doc-2', 'doc-3', 'job-4', 'job-5', 'doc-None']
+
+
+def test_two_phase_offset(make_client):
+    es = two_phase_stub()
+    client = make_client(es)
+
+    result = client.get('/api/search/jobs,docs?q=x&size=3&offset=2&two_phase=1').get_json()
+
+    assert titles(result) == ['job-7', 'doc-6', 'job-5']
+    assert all(body['size'] == 5 for _, body in es.searches[:2])
+
+
+def test_two_phase_past_last_page(make_client):
+    es = two_phase_stub()
+    client = make_client(es)
+
+    result = client.get('/api/search/jobs,docs?q=x&size=3&offset=20&two_phase=1').get_json()
+
+    assert result['search_results'] == []
+    assert result['search_counts']['_current'] == dict(total_overall=9)
+    # There's no page to fetch
+    assert len(es.searches) == 2
+
+
+def test_two_phase_missing_document(make_client):
+    # A document deleted between the phases is skipped
+    es = two_phase_stub(missing=['doc-8'])
+    client = make_client(es)
+
+    result = client.get('/api/search/jobs,docs?q=x&size=3&two_phase=1').get_json()
+
+    assert titles(result) == ['job-9', 'job-7']
+
+
+def test_two_phase_type_filters(make_client):
+    # The page only holds results of one type, but the filters of both types still apply
+    es = two_phase_stub()
+    client = make_client(es)
+    filters = '[{"_type": "jobs", "kind": "x"}, {"_type": "docs", "kind": "y"}]'
+
+    result = client.get('/api/search/jobs,docs?q=x&size=1&two_phase=1&filter=' + filters).get_json()
+
+    assert titles(result) == ['job-9']
@@ -0,0 +1,24 @@
+from .stubs import StubES, hit
+
+
+def test_suggest(make_client):
+    es = StubES({
+        'jobs-index': [hit('job-1', 3.0), hit('job-2', 1.0)],
+        'docs-index': [hit('doc-1', 2.0)],
+    })
+    client = make_client(es)
+
+    result = client.get('/api/suggest/jobs,docs?q=eng&size=2').get_json()
+
+    assert result == dict(suggestions=[
+        dict(id='job-1', type='jobs', score=3.0, source=dict(title='job-1')),
+        dict(id='doc-1', type='docs', score=2.0, source=dict(title='doc-1')),
+    ])
+
+
+def test_suggest_empty_term(make_client):
+    es = StubES({})
+    client = make_client(es)
+
+    assert client.get('/api/suggest/jobs?q=').get_json() == dict(suggestions=[])
+    assert es.searches == []